@@ -60,9 +60,11 @@ class PsCanvasController:
         if scroll > 0:
             # scrolling forward -> +1 slice
             new_slice = self.model.set_next_slice()
+            direction = 1
         elif scroll < 0:
             # scrolling backward -> -1 slice
             new_slice = self.model.set_previous_slice()
+            direction = -1
         else:
             return
 
@@ -88,6 +90,8 @@ class PsCanvasController:
             self.model.c.signal_update_status_bar.emit(e.message)
             return
         self.model.reload_all_images()
+        # the user is likely to keep scrolling in the same direction
+        self.model.prefetch_slices(direction)
 
     def mouse_press_handler(self, event):
         self.view.smap_view.canvas.setFocus()
@@ -214,9 +218,11 @@ class PsCanvasController:
                 if delta > 0:
                     # scrolling forward -> +1 slice
                     new_slice = self.model.set_next_slice()
+                    direction = 1
                 elif delta < 0:
                     # scrolling backward -> -1 slice
                     new_slice = self.model.set_previous_slice()
+                    direction = -1
                 else:
                     return
                 slice_slider = self.model.slice_slider[self.model.get_orientation()]
@@ -231,6 +237,7 @@ class PsCanvasController:
                 try:
                     self.model.recompute_smap()
                     self.model.reload_all_images()
+                    self.model.prefetch_slices(direction)
 
                     self.last_pos_slice = curr_pos
                 except NotSelectedMapError as e:
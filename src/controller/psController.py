@@ -10,7 +10,7 @@ from PyQt5 import QtCore, QtGui
 from PyQt5.QtGui import QCursor
 
 from src.model.MRIImage import Orientation, Interpolation
-from src.model.psExceptions import NotSelectedMapError, ConfigurationFilePermissionError
+from src.model.psExceptions import NotSelectedMapError, ConfigurationFilePermissionError, EquationError
 from src.model.psFileType import psFileType
 from src.model.psModel import PsModel
 from src.model.utils import get_unique_filename
@@ -251,7 +251,11 @@ class PsController:
         log.debug("on_clicked_custom_smap_button")
         dlg = PsCustomSmapDialog()
         if dlg.exec():
-            self.model.add_custom_smap(dlg.custom_smap)
+            try:
+                self.model.add_custom_smap(dlg.custom_smap)
+            except EquationError as e:
+                self.model.c.signal_update_status_bar.emit(e.message)
+                return
             self.model.reload_smap()
             map_type = dlg.custom_smap["name"]
             self.view.add_custom_smap(map_type)
@@ -393,8 +397,8 @@ class PsController:
             slider_widget.textQ.setText(str(value))
             self.model.set_smap_parameter_value(parameter_type, value)
             # self.model.modify_syntetic_map(dims=2)
-            self.model.recompute_smap()
-            self.model.reload_smap()
+            # computed in background (preview while dragging), reloaded when ready
+            self.model.schedule_recompute_smap(preview=True)
         # self.model.update_image()
         # print(smap_type, parameter)
 
@@ -9,8 +9,17 @@ import numpy as np
 import pydicom
 from pydicom.uid import generate_uid
 
+from src.model.psDicomIndex import DicomIndex
+from src.model.psDicomReader import read_headers, check_geometry, read_pixels, get_rescale
+from src.model.psEquation import TermCache, reciprocal_key, lut_key, build_lut, lut_range, lut_grid, lut_index, \
+    evaluate_many
 from src.model.psExceptions import NotLoadedMapError, NotSelectedMapError
 from src.model.psFileType import psFileType
+from src.model.psForeground import ForegroundVoxels, compact, expand
+from src.model.psMask import ForegroundMask
+from src.model.psSliceCache import SliceCache
+from src.model.psSynthEngine import NumpyBackend, sweep
+from src.model.utils import safe_reciprocal
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +56,8 @@ class MRIImage:
     np_matrix_3d = None
     # image orientation, default axial
     _orientation = None
+    # MemoryManager the large arrays are registered with, None: no accounting
+    _memory = None
 
     map_type = ""
     file_type = ""  # niftii, dicom
@@ -74,13 +85,14 @@ class MRIImage:
             return
         # set init orientation and sliceposition
 
-        self.slices_num[Orientation.AXIAL] = round(self.np_matrix.shape[2] / 2) - 1
-        self.slices_num[Orientation.SAGITTAL] = round(self.np_matrix.shape[0] / 2) - 1
-        self.slices_num[Orientation.CORONAL] = round(self.np_matrix.shape[1] / 2) - 1
+        shape = self.get_matrix_shape()
+        self.slices_num[Orientation.AXIAL] = round(shape[2] / 2) - 1
+        self.slices_num[Orientation.SAGITTAL] = round(shape[0] / 2) - 1
+        self.slices_num[Orientation.CORONAL] = round(shape[1] / 2) - 1
 
-        self.total_slices_num[Orientation.AXIAL] = self.np_matrix.shape[2]
-        self.total_slices_num[Orientation.SAGITTAL] = self.np_matrix.shape[0]
-        self.total_slices_num[Orientation.CORONAL] = self.np_matrix.shape[1]
+        self.total_slices_num[Orientation.AXIAL] = shape[2]
+        self.total_slices_num[Orientation.SAGITTAL] = shape[0]
+        self.total_slices_num[Orientation.CORONAL] = shape[1]
 
     def set_map_type(self, map_type: str):
         self.map_type = map_type
@@ -90,6 +102,34 @@ class MRIImage:
 
     def set_matrix(self, np_matrix):
         self.np_matrix = np_matrix
+        self.invalidate_derived()
+
+    def invalidate_derived(self):
+        """
+        Drop arrays derived from np_matrix. Called when a new matrix is set or loaded.
+        """
+        pass
+
+    def set_memory_manager(self, memory):
+        self._memory = memory
+
+    def get_memory_owner(self):
+        return self.map_type
+
+    def track_memory(self, name, nbytes, evict=None):
+        """
+        Register nbytes held under name with the memory manager (see MemoryManager.track).
+        """
+        if self._memory is not None:
+            self._memory.track((self.get_memory_owner(), name), nbytes, evict)
+
+    def touch_memory(self, name):
+        if self._memory is not None:
+            self._memory.touch((self.get_memory_owner(), name))
+
+    def release_memory(self, name):
+        if self._memory is not None:
+            self._memory.release((self.get_memory_owner(), name))
 
     def update_min_max(self):
         self._m_max = self.np_matrix.max()
@@ -101,7 +141,7 @@ class MRIImage:
     def get_min_value(self):
         return self._m_min
 
-    def get_matrix(self, dim):
+    def get_matrix(self, dim, position=None):
 
         if self.np_matrix is None:
             # log.debug("Requesting None image")
@@ -110,20 +150,54 @@ class MRIImage:
             # smap case is never computed in 3d till save
             return self.np_matrix
 
-        np_matrix_3d = self.np_matrix
+        return self.get_oriented_matrix(self.np_matrix, dim, position)
+
+    def get_position(self):
+        """
+        Displayed slice: (orientation, slice number).
+        """
+        return self._orientation, self.slices_num[self._orientation]
 
+    def get_oriented_matrix(self, np_matrix_3d, dim, position=None):
+        """
+        Return a slice of a volume aligned with this image (dim=2) or the whole volume (dim=3).
+        position: (orientation, slice number) of the slice, default the displayed one
+        """
         if dim == 2:
-            if self._orientation == Orientation.AXIAL:
-                return np.fliplr(np.rot90(np_matrix_3d[:, :, self.slices_num[Orientation.AXIAL]]))
-            elif self._orientation == Orientation.SAGITTAL:
-                return np.fliplr(np.rot90(np_matrix_3d[self.slices_num[Orientation.SAGITTAL], :, :]))
-            elif self._orientation == Orientation.CORONAL:
-                return np.fliplr(np.rot90(np_matrix_3d[:, -self.slices_num[Orientation.CORONAL], :]))
+            axis, index = self.get_slice_index(position)
+            return np.fliplr(np.rot90(np_matrix_3d[(slice(None),) * axis + (index,)]))
         else:
             return np_matrix_3d
 
-    def get_mask(self, threshold=0.01, dims=2):
-        return self._qmaps[list(self._qmaps.keys())[0]].get_matrix(dims) > threshold
+    def get_oriented_mask(self, mask, dim, position=None):
+        """
+        Same as get_oriented_matrix for a ForegroundMask: only the requested slice is unpacked.
+        """
+        if dim == 2:
+            return np.fliplr(np.rot90(mask.plane(*self.get_slice_index(position))))
+        else:
+            return mask.volume()
+
+    def get_oriented_volume(self, np_matrix_3d, orientation):
+        """
+        Return a C-contiguous copy of a volume whose first axis runs across the slices of orientation, each slice
+        laid out as returned by get_oriented_matrix: volume[index] is the slice at (axis, index) of get_slice_index.
+        """
+        axis, _ = self.get_slice_index((orientation, 0))
+        stack = np.flip(np.rot90(np.moveaxis(np_matrix_3d, axis, 0), axes=(1, 2)), axis=2)
+        return np.ascontiguousarray(stack)
+
+    def get_slice_index(self, position=None):
+        """
+        Return (axis, index) of a slice (default the displayed one) in the volume.
+        """
+        orientation, slice_num = position if position is not None else self.get_position()
+        if orientation == Orientation.AXIAL:
+            return 2, slice_num
+        elif orientation == Orientation.SAGITTAL:
+            return 0, slice_num
+        elif orientation == Orientation.CORONAL:
+            return 1, -slice_num
 
     def get_matrix_shape(self):
         return self.np_matrix.shape
@@ -244,8 +318,15 @@ class MRIImage:
 
 
 class Qmap(MRIImage):
-    def __init__(self, map_type: str, path=None, is_loaded=False):
+    # loaded volume, see np_matrix
+    _matrix = None
+    # NIfTI image read on demand until the whole volume is needed (see load_from_niftii), None if not lazy
+    _niftii = None
+
+    def __init__(self, map_type: str, path=None, is_loaded=False, dtype=np.float64):
         super(Qmap, self).__init__()
+        # dtype of the loaded volume, used for synthesis
+        self.dtype = np.dtype(dtype)
         self.set_map_type(map_type)
         self.path = path
         self.is_loaded = is_loaded
@@ -254,44 +335,179 @@ class Qmap(MRIImage):
         self.slice_spacing = 0.
         self._colormap = Colormap.COLORMAP_HOT
         self._inverted = False
+        # incremented each time a new volume is loaded
+        self.generation = 0
+        # lazily computed 1/np_matrix
+        self._reciprocal = None
+        # lazily computed quantized map for table lookup: (index volume, table values, max relative error)
+        self._lut = None
+        # keep a contiguous copy of the volumes for each displayed orientation (faster slicing, more memory)
+        self._oriented_copies = False
+        # (volume name, orientation) -> oriented copy (see get_oriented_volume)
+        self._oriented = dict()
+        # (volume name, factor) -> downsampled volume (see get_pyramid_level)
+        self._pyramid = dict()
+        # VolumeCache of the loaded volumes, None if disabled
+        self._volume_cache = None
+        # files of the loaded DICOM series
+        self._dicom_files = []
+
+    @property
+    def np_matrix(self):
+        """
+        Loaded volume. A lazily loaded NIfTI volume is read in memory on first access (see materialize).
+        """
+        if self._matrix is None and self._niftii is not None:
+            self.materialize()
+        return self._matrix
+
+    @np_matrix.setter
+    def np_matrix(self, np_matrix):
+        self._matrix = np_matrix
+        self._niftii = None
+
+    def is_lazy(self):
+        """
+        True if the volume is read on demand and not (or no more) in memory.
+        """
+        return self._matrix is None and self._niftii is not None
+
+    def materialize(self):
+        """
+        Read the whole lazily loaded volume in memory. It can be evicted by the memory manager: it is read again from
+        the file when needed.
+        """
+        self._matrix = self._niftii.get_fdata(dtype=self.dtype, caching="unchanged")
+        self.update_min_max()
+        self.track_memory("map", self._matrix.nbytes, lambda: self._evict("map"))
+        log.info("{} qmap read in memory".format(self.map_type))
+
+    def get_matrix_shape(self):
+        if self.is_lazy():
+            return self._niftii.shape
+        return super(Qmap, self).get_matrix_shape()
+
+    def get_lazy_slice(self, position=None):
+        """
+        Read a slice of the lazily loaded volume from the file. Min and max cover the slices read so far, until the
+        whole volume is read.
+        """
+        np_matrix_2d = self.get_oriented_matrix(self._niftii.dataobj, 2, position).astype(self.dtype, copy=False)
+        if np_matrix_2d.size:
+            self._m_max = np_matrix_2d.max() if self._m_max is None else max(self._m_max, np_matrix_2d.max())
+            self._m_min = np_matrix_2d.min() if self._m_min is None else min(self._m_min, np_matrix_2d.min())
+        return np_matrix_2d
 
-    def load_from_dicom(self):
+    def get_lazy_planes(self, step=1):
+        """
+        Iterate over (index, plane) of the planes across the last axis of the lazily loaded volume, one every step,
+        read one at a time from the file. Min and max are updated when the whole volume is read.
+        """
+        dataobj = self._niftii.dataobj
+        m_min = m_max = None
+        for index in range(0, dataobj.shape[2], step):
+            plane = np.asarray(dataobj[:, :, index]).astype(self.dtype, copy=False)
+            if plane.size:
+                m_max = plane.max() if m_max is None else max(m_max, plane.max())
+                m_min = plane.min() if m_min is None else min(m_min, plane.min())
+            yield index, plane
+        if step == 1:
+            self._m_min, self._m_max = m_min, m_max
+
+    def get_threshold_mask(self, threshold):
+        """
+        Boolean volume of the voxels above threshold. A lazily loaded volume is read plane by plane and stays lazy.
+        """
+        if not self.is_lazy():
+            return self.np_matrix > threshold
+        mask = np.empty(self._niftii.shape, dtype=bool)
+        for index, plane in self.get_lazy_planes():
+            mask[:, :, index] = plane > threshold
+        return mask
+
+    def get_values(self, indices):
+        """
+        Values of the voxels at flat (C order) indices. A lazily loaded volume is read plane by plane and stays lazy.
+        """
+        if not self.is_lazy():
+            return np.take(self.np_matrix, indices)
+        rows, columns, planes = np.unravel_index(indices, self._niftii.shape)
+        values = np.empty(indices.size, dtype=self.dtype)
+        for index, plane in self.get_lazy_planes():
+            selected = planes == index
+            values[selected] = plane[rows[selected], columns[selected]]
+        return values
+
+    def load_from_dicom(self, workers=0, progress=None, series_description="", index_directory=""):
+        """
+        Load a DICOM series found below path. The series is selected in the index of the folder (see psDicomIndex):
+        the only one there, or the only one whose description matches series_description.
+        The files are read in two concurrent passes (see psDicomReader): headers first, to sort the slices and size
+        the volume, then pixel data, decoded in the native type of the series.
+        The stored values are then converted, in a single pass, to real values (RescaleSlope and RescaleIntercept,
+        if any) and to the qmap orientation and dtype.
+        workers: reading threads (0: one per CPU)
+        progress: optional callable(done, total) called after each file of the index update, then of each pass, total
+                  fixed before the index update
+        series_description: pattern of the SeriesDescription (shell-style wildcards, case insensitive)
+        index_directory: where the folder index is kept (default ~/.pySynthMRI/dicom_index)
+        """
         path = Path(self.path)
         qmap_type = self.map_type
+        # a single progress over the index update and the two passes, each counted as the files of the folder
+        files = max(1, sum(len(names) for _, _, names in os.walk(path)))
+
+        def report(phase):
+            return progress and (lambda done, count: progress(phase * files + files * done // count, 3 * files))
+
+        try:
+            index = DicomIndex(path, index_directory)
+            index.update(workers, report(0))
+            file_list = index.select(series_description).files
+        except Exception as e:
+            log.error("{} qmap: {}".format(qmap_type, e))
+            e.dicom_map_type = path
+            raise e
+        self._dicom_files = file_list
+        cache_key = self.get_volume_cache_key(file_list)
+        if self.load_from_cache(cache_key, psFileType.DICOM):
+            return
         # load the DICOM files
-        # log.debug('Loading dicom: {}'.format(wildcard_path))
-        file_list = [str(pp) for pp in path.glob("**/*")]
-        files = []
-        for fname in file_list:
-            try:
-                dicom_file = pydicom.dcmread(fname)
-                files.append(dicom_file)
-            except Exception as e:
-                print(e)
-                e.dicom_map_type = path
-                raise e
-
-        log.info("Loading {} files for {} qmap...".format(len(files), qmap_type))
-        # ensure they are in the correct order
-        slices = sorted(files, key=lambda s: s.SliceLocation)
-
-        # create 3D array
-        img_shape = list(slices[0].pixel_array.shape)
-        slice_spacing = slices[0].PixelSpacing
-        dcm_header = slices[0]
-        img_shape.append(len(slices))
-        self.np_matrix = np.zeros(img_shape)
-
-        # fill 3D array with the images from the files
-        for i, s in enumerate(slices):
-            self.np_matrix[:, :, i] = np.rot90(np.flipud(s.pixel_array)).copy()
+        log.info("Loading {} files for {} qmap...".format(len(file_list), qmap_type))
+        try:
+            slices = read_headers(file_list, workers, report(1))
+            shape, native_dtype = check_geometry(slices)
+            # slices stacked in file order: (slice, row, column)
+            stored = np.empty(shape, dtype=native_dtype)
+            read_pixels(slices, stored, workers, report(2))
+        except Exception as e:
+            log.error("{} qmap: {}".format(qmap_type, e))
+            e.dicom_map_type = path
+            raise e
+
+        # (column, flipped row, slice) view of the stored values: each plane rotated as np.rot90(np.flipud(plane))
+        oriented = stored[:, ::-1, ::-1].transpose(2, 1, 0)
+        self.np_matrix = np.empty(oriented.shape, dtype=self.dtype)
+        rescale = get_rescale(slices)
+        if rescale is None:
+            self.np_matrix[...] = oriented
+        else:
+            slope, intercept = rescale
+            np.multiply(oriented, slope.astype(self.dtype), out=self.np_matrix)
+            self.np_matrix += intercept.astype(self.dtype)
+        del stored, oriented
 
         # set init orientation and sliceposition
         self.set_init_slices_num()
         self.file_type = psFileType.DICOM
+        # headers only: the pixel data of the templates is replaced when saving
         self.original_template = slices
         self.update_min_max()
-        self.slice_spacing = slice_spacing
+        self.slice_spacing = slices[0].PixelSpacing
+        self.generation += 1
+        self.invalidate_derived()
+        self.track_memory("map", self.np_matrix.nbytes)
+        self.save_to_cache(cache_key)
 
     def check_orientation(self, niftii, img):
         """
@@ -310,21 +526,242 @@ class Qmap(MRIImage):
             ct_arr = nib.orientations.flip_axis(img, axis=2)
         return img
 
-    def load_from_niftii(self):
+    def load_from_niftii(self, lazy=False):
+        """
+        Load a NIfTI file.
+        lazy: for uncompressed files, read the displayed slices on demand from the file (memory mapped when possible)
+              and the whole volume only when it is needed (synthesis), see materialize
+        """
         path = self.path
         qmap_type = self.map_type
         log.info("Loading file for {} qmap...".format(qmap_type))
+        lazy = lazy and not str(path).lower().endswith(".gz")
+        # a lazy volume is read on demand: nothing to gain from the cache
+        cache_key = None if lazy else self.get_volume_cache_key()
+        if self.load_from_cache(cache_key, psFileType.NIFTII):
+            return
         niftii_file = nib.load(path)
-        self.np_matrix = niftii_file.get_fdata()
+        if lazy:
+            self.np_matrix = None
+            self._niftii = niftii_file
+            self._m_max = self._m_min = None
+            self.release_memory("map")
+        else:
+            self.np_matrix = niftii_file.get_fdata(dtype=self.dtype)
+            self.update_min_max()
+            self.track_memory("map", self.np_matrix.nbytes)
         # self.np_matrix = self.check_orientation(niftii_file, self.np_matrix)
         self.header = niftii_file.header
         self.file_type = psFileType.NIFTII
         self.set_init_slices_num()
-        self.update_min_max()
         self.slice_spacing = self.header['pixdim'][1:3]
+        self.generation += 1
+        self.invalidate_derived()
+        self.save_to_cache(cache_key)
+
+    def set_volume_cache(self, volume_cache):
+        self._volume_cache = volume_cache
+
+    def get_volume_cache_key(self, files=None):
+        """
+        Key of the volume of path (made of files, default all the files below path) in the volume cache, None if the
+        cache is disabled.
+        """
+        if self._volume_cache is None or not self._volume_cache.enabled():
+            return None
+        return self._volume_cache.get_key(self.path, self.dtype, files)
+
+    def load_from_cache(self, cache_key, file_type):
+        """
+        Load the volume cached under cache_key, memory mapped. Returns False if it is not in the cache.
+        The DICOM templates are read again only when needed (see get_dicom).
+        """
+        cached = self._volume_cache.get(cache_key) if cache_key is not None else None
+        if cached is None:
+            return False
+        self.np_matrix, meta = cached
+        self.file_type = file_type
+        self.original_template = None
+        if file_type == psFileType.NIFTII:
+            # header only, the data is not read
+            self.header = nib.load(self.path).header
+        self.set_init_slices_num()
+        self._m_min, self._m_max = meta["min"], meta["max"]
+        self.slice_spacing = meta["slice_spacing"]
+        self.generation += 1
+        self.invalidate_derived()
+        self.track_memory("map", self.np_matrix.nbytes)
+        log.info("{} qmap loaded from the volume cache".format(self.map_type))
+        return True
+
+    def save_to_cache(self, cache_key):
+        if cache_key is None or self.is_lazy():
+            return
+        meta = {"source": os.path.abspath(str(self.path)),
+                "map_type": self.map_type,
+                "file_type": self.file_type,
+                "shape": list(self.np_matrix.shape),
+                "dtype": self.dtype.str,
+                "min": float(self._m_min),
+                "max": float(self._m_max),
+                "slice_spacing": [float(v) for v in self.slice_spacing]}
+        self._volume_cache.put(cache_key, self.np_matrix, meta)
+
+    def invalidate_derived(self):
+        self._reciprocal = None
+        self._lut = None
+        self.release_memory("reciprocal")
+        self.release_memory("lut")
+        for name in list(self._pyramid):
+            self.release_memory(("pyramid",) + name)
+        self._pyramid = dict()
+        self.set_oriented_copies(self._oriented_copies)
+
+    def set_oriented_copies(self, oriented_copies):
+        self._oriented_copies = oriented_copies
+        for name in list(self._oriented):
+            self.release_memory(("oriented",) + name)
+        self._oriented = dict()
+
+    def _evict(self, name):
+        # drop a derived volume (see track_memory), rebuilt on next request
+        if name == "map":
+            # only registered as evictable when it can be read again from the file
+            self._matrix = None
+        elif name == "reciprocal":
+            self._reciprocal = None
+        elif name == "lut":
+            self._lut = None
+        elif name[0] == "oriented":
+            self._oriented.pop(name[1:], None)
+        elif name[0] == "pyramid":
+            self._pyramid.pop(name[1:], None)
+
+    def get_matrix(self, dim, position=None):
+        if dim == 2 and self.is_lazy():
+            return self.get_lazy_slice(position)
+        if dim == 2 and self.np_matrix is not None and self._oriented_copies:
+            return self.get_oriented_slice("map", self.np_matrix, position)
+        return super(Qmap, self).get_matrix(dim, position)
+
+    def get_oriented_slice(self, name, np_matrix_3d, position=None):
+        """
+        Return a slice of np_matrix_3d (the volume called name: map, reciprocal, ...) as a contiguous view of its
+        oriented copy, built on first request in each orientation.
+        """
+        orientation = position[0] if position is not None else self._orientation
+        _, index = self.get_slice_index(position)
+        key = (name, orientation)
+        try:
+            oriented = self._oriented[key]
+            self.touch_memory(("oriented",) + key)
+        except KeyError:
+            oriented = self.get_oriented_volume(np_matrix_3d, orientation)
+            self._oriented[key] = oriented
+            self.track_memory(("oriented",) + key, oriented.nbytes, lambda: self._evict(("oriented",) + key))
+            log.debug("{} qmap: {} {} volume copy built".format(self.map_type, orientation, name))
+        return oriented[index]
+
+    def get_reciprocal_matrix(self, dim, position=None):
+        """
+        Return 1/map (relaxation rate for T1, T2 maps), inf where the map is 0 (see safe_reciprocal).
+        The reciprocal volume is computed once and kept until a new map is loaded.
+        """
+        if dim == 2 and self.is_lazy() and self._reciprocal is None:
+            return safe_reciprocal(self.get_lazy_slice(position))
+        if self.np_matrix is None:
+            return None
+        reciprocal = self._reciprocal
+        if reciprocal is None:
+            reciprocal = self._reciprocal = safe_reciprocal(self.np_matrix)
+            self.track_memory("reciprocal", reciprocal.nbytes, lambda: self._evict("reciprocal"))
+        else:
+            self.touch_memory("reciprocal")
+        if dim == 2 and self._oriented_copies:
+            return self.get_oriented_slice("reciprocal", reciprocal, position)
+        return self.get_oriented_matrix(reciprocal, dim, position)
+
+    def get_lut(self, size):
+        """
+        Return the quantized map used for table lookup synthesis (see psEquation.build_lut):
+        (index volume, map values for each index, max relative quantization error).
+        Built once per loaded map and table size.
+        """
+        lut = self._lut
+        if lut is None or lut[1].size != size:
+            lut = self._lut = self.build_lazy_lut(size) if self.is_lazy() else build_lut(self.np_matrix, size)
+            self.track_memory("lut", lut[0].nbytes, lambda: self._evict("lut"))
+            log.info("{} qmap quantized on {} values (max relative error {:.2e})".format(
+                self.map_type, size, lut[2]))
+        else:
+            self.touch_memory("lut")
+        return lut
+
+    def build_lazy_lut(self, size):
+        """
+        Same as psEquation.build_lut for the lazily loaded volume, read plane by plane (twice: range, then indexes).
+        """
+        ranges = [value_range for value_range in (lut_range(plane) for _, plane in self.get_lazy_planes())
+                  if value_range is not None]
+        value_range = (min(r[0] for r in ranges), max(r[1] for r in ranges)) if ranges else None
+        grid, error = lut_grid(value_range, size, self.dtype)
+        index = np.empty(self._niftii.shape, dtype=np.uint16)
+        for i, plane in self.get_lazy_planes():
+            index[:, :, i] = lut_index(plane, value_range, size)
+        return index, grid, error
+
+    def get_lut_matrix(self, dim, size, position=None):
+        if dim == 2 and self._oriented_copies:
+            return self.get_oriented_slice("lut", self.get_lut(size)[0], position)
+        return self.get_oriented_matrix(self.get_lut(size)[0], dim, position)
+
+    def get_pyramid_level(self, np_matrix_3d, factor, name="map"):
+        """
+        Return np_matrix_3d (the volume called name: map, reciprocal, ...) downsampled by factor along each axis,
+        keeping one voxel every factor. Built once per loaded map.
+        """
+        return self.get_cached_level(name, factor,
+                                     lambda: np.ascontiguousarray(np_matrix_3d[::factor, ::factor, ::factor]))
+
+    def get_map_level(self, factor):
+        """
+        Return the map downsampled by factor (see get_pyramid_level). A lazily loaded volume is read plane by plane and
+        stays lazy.
+        """
+        if not self.is_lazy():
+            return self.get_pyramid_level(self.np_matrix, factor)
+        return self.get_cached_level("map", factor, lambda: np.stack(
+            [plane[::factor, ::factor] for _, plane in self.get_lazy_planes(factor)], axis=2))
+
+    def get_reciprocal_level(self, factor):
+        """
+        Return 1/map downsampled by factor, as get_map_level.
+        """
+        if not self.is_lazy():
+            return self.get_pyramid_level(self.get_reciprocal_matrix(dim=3), factor, "reciprocal")
+        return self.get_cached_level("reciprocal", factor, lambda: safe_reciprocal(self.get_map_level(factor)))
+
+    def get_cached_level(self, name, factor, build):
+        """
+        Return the pyramid level (name, factor), computed by build() on first request.
+        """
+        key = (name, factor)
+        try:
+            level = self._pyramid[key]
+            self.touch_memory(("pyramid",) + key)
+            return level
+        except KeyError:
+            pass
+        level = build()
+        self._pyramid[key] = level
+        self.track_memory(("pyramid",) + key, level.nbytes, lambda: self._evict(("pyramid",) + key))
+        return level
 
     def get_dicom(self):
         if self.file_type == psFileType.DICOM:
+            if self.original_template is None:
+                # loaded from the volume cache: headers only, the pixel data is replaced when saving
+                self.original_template = read_headers(self._dicom_files)
             return self.original_template
         elif self.file_type == psFileType.NIFTII:
             # need conversion
@@ -385,10 +822,64 @@ class Smap(MRIImage):
         self._horizontal_parameter = None
         self._series_number = None
         self._header = dict()
+        # sub-terms of the equation computed on the current slice
+        self._term_cache = TermCache()
+        self._backend = NumpyBackend()
+        # table lookup synthesis: number of table entries, 0 if disabled
+        self._lut_size = 0
+        # foreground voxels of the loaded subject
+        self._foreground = None
+        # (foreground mask, flat indices of its voxels), kept while its source qmap is not reloaded
+        self._mask = None
+        # volumes synthesized in advance (see prepare_volumes)
+        self._volumes = dict()
+        # foreground mask downsampled for preview synthesis: ((mask key, factor), mask)
+        self._preview_mask = None
+        # memory for the temporaries of chunked evaluations (3D synthesis), in bytes
+        self._chunk_memory = 2 ** 28
+        # foreground mask: source qmap (first qmap if empty), threshold, morphological cleanup iterations
+        self._mask_options = ("", 0.01, 0)
+        # intensity scaling of each synthesis state (see get_scaling)
+        self._scaling = dict()
+        # foreground voxels sampled to estimate the intensity scaling, 0: all
+        self._scaling_samples = 0
+        # recently synthesized slices
+        self._slice_cache = SliceCache()
 
     def set_map_type(self, map_type):
         super(Smap, self).set_map_type(map_type)
 
+    def set_backend(self, backend):
+        # release the worker threads of the replaced backend
+        if self._backend is not backend:
+            self._backend.shutdown()
+        self._backend = backend
+
+    def get_backend(self):
+        return self._backend
+
+    def set_lut_size(self, lut_size):
+        self._lut_size = lut_size
+        self._term_cache.clear()
+        self._slice_cache.clear()
+
+    def get_slice_cache(self):
+        return self._slice_cache
+
+    def get_memory_owner(self):
+        return "synthetic"
+
+    def set_chunk_memory(self, chunk_memory):
+        self._chunk_memory = chunk_memory
+
+    def set_mask_options(self, source="", threshold=0.01, cleanup=0):
+        self._mask_options = (source, threshold, cleanup)
+
+    def set_scaling_samples(self, scaling_samples):
+        self._scaling_samples = scaling_samples
+        self._scaling.clear()
+        self._slice_cache.clear()
+
     def set_equation(self, equation):
         self._equation = equation
 
@@ -491,35 +982,409 @@ class Smap(MRIImage):
             self._parameters[self._horizontal_parameter]["value"] = param_value
             return param_value
 
+    def check_synthesis_inputs(self):
+        # check if all needed quantitative maps are loaded
+        if self.get_missing_qmaps():
+            raise NotLoadedMapError("{} map not laoded!".format(', '.join(self.get_missing_qmaps())))
+        if not self._equation:
+            raise NotSelectedMapError("Synthetic image not selected!")
+
     def recompute_smap(self, dims=2):
         # eval equation
         # log.debug(self._equation)
+        self.check_synthesis_inputs()
 
-        # check if all needed quantitative maps are loaded
+        if dims == 2:
+            self.np_matrix = self.synthesize_slice(term_cache=self._term_cache)
+            return
+
+        self.np_matrix_3d = self.synthesize_volume()
+        self.track_memory("volume", self.np_matrix_3d.nbytes, self._evict_volume)
+
+    def _evict_volume(self):
+        # recomputed by recompute_smap(dims=3) before each export
+        self.np_matrix_3d = None
+
+    def synthesize_volume(self):
+        """
+        Synthesize the whole volume of the current smap (see synthesize_volumes), unless it was already synthesized
+        with the other contrasts of its preset.
+        """
+        state = self.get_synthesis_state()
+        volume = self._volumes.pop(self.get_volume_key(state), None)
+        self.track_memory("prepared volumes", sum(v.nbytes for v in self._volumes.values()), self._evict_volumes)
+        if volume is not None:
+            return volume
+        return self.synthesize_volumes([state])[0]
+
+    def synthesize_volumes(self, states):
+        """
+        Synthesize whole volumes slab by slab: the foreground voxels are evaluated in chunks of consecutive voxels
+        (slabs across the first axis) sized so that the temporaries of a chunk stay within the chunk memory, and
+        written, scaled, in preallocated float32 volumes.
+        states: synthesis states (see get_synthesis_state) of the smaps to synthesize, all evaluated on each chunk
+                sharing their common sub-terms
+        """
+        if not states:
+            return []
+        inputs = dict()
+        for state in states:
+            inputs.update(self.get_equation_inputs(3, equation=state[1]))
+        luts = self.get_equation_luts(states[0][1]) if len(states) == 1 else self.get_all_luts(states)
+        foreground = states[0][4]
+        itemsize = max([inputs[k].dtype.itemsize for k in inputs] + [np.dtype(np.float32).itemsize])
+        # gathered inputs, equation temporaries and result of a chunk
+        terms = sum(state[1].array_terms + 1 for state in states)
+        chunk = max(1, self._chunk_memory // (itemsize * (len(inputs) + terms)))
+
+        # background voxels are 0 once scaled (see get_scaling)
+        volumes = [np.zeros(foreground.shape, dtype=np.float32) for _ in states]
+        for start in range(0, foreground.size(), chunk):
+            indices = foreground.indices[start:start + chunk]
+            qmaps = {k: np.take(inputs[k], indices) for k in inputs}
+            if len(states) == 1:
+                synths = [self._backend.evaluate(states[0][1], qmaps, states[0][2], luts=luts)]
+            else:
+                synths = evaluate_many([state[1] for state in states], qmaps, [state[2] for state in states], luts)
+            for volume, synth, state in zip(volumes, synths, states):
+                volume.reshape(-1)[indices] = self.scale(np.abs(np.nan_to_num(synth)), state)
+        log.debug("synthesize_volumes: {} smaps, {} voxels in chunks of {}".format(
+            len(states), foreground.size(), chunk))
+        return volumes
+
+    def prepare_volumes(self, states):
+        """
+        Synthesize in one pass the volumes of several smaps, kept until synthesize_volume asks for them
+        (batch export). Only the volumes fitting in the memory budget left are prepared, the others are synthesized
+        one at a time by synthesize_volume.
+        """
+        self.release_volumes()
+        if states and self._memory is not None and self._memory.budget:
+            nbytes = int(np.prod(states[0][4].shape)) * np.dtype(np.float32).itemsize
+            states = states[:max(0, (self._memory.budget - self._memory.nbytes()) // nbytes)]
+            if len(states) < 2:
+                # nothing shared
+                return
+        for state, volume in zip(states, self.synthesize_volumes(states)):
+            self._volumes[self.get_volume_key(state)] = volume
+        self.track_memory("prepared volumes", sum(v.nbytes for v in self._volumes.values()), self._evict_volumes)
+
+    def release_volumes(self):
+        """
+        Drop the prepared volumes not asked for (e.g. at the end of a batch subject).
+        """
+        self._evict_volumes()
+        self.release_memory("prepared volumes")
+
+    def _evict_volumes(self):
+        # synthesize_volume computes the volumes not found
+        self._volumes = dict()
+
+    def get_volume_key(self, state):
+        map_type, equation, params, values, foreground = state
+        return map_type, equation, values, foreground.key
+
+    def synthesize_contrasts(self, states, position=None):
+        """
+        Synthesize in one pass a slice of several smaps (e.g. all the contrasts of the current preset) into the slice
+        cache, sharing their common sub-terms. Slices already cached are skipped.
+        position: as in synthesize_slice
+        """
+        states = [state for state in states if not self._slice_cache.contains(self.get_cache_key(position, state))]
+        if not states:
+            return
+        foreground = states[0][4]
+        mask = self.get_oriented_mask(foreground.mask, 2, position)
+        inputs = dict()
+        for state in states:
+            inputs.update(self.get_equation_inputs(2, position, state[1]))
+        synths = evaluate_many([state[1] for state in states], compact(inputs, mask), [state[2] for state in states],
+                               self.get_all_luts(states))
+        for synth, state in zip(synths, states):
+            img = self.scale(expand(np.abs(np.nan_to_num(synth)), mask), state)
+            self.cache_slice(self.get_cache_key(position, state), img)
+        log.debug("synthesize_contrasts: {} smaps".format(len(states)))
+
+    def get_all_luts(self, states):
+        """
+        Lookup table values of all the equations of states, None if table lookup is disabled.
+        """
+        if not self._lut_size:
+            return None
+        luts = dict()
+        for state in states:
+            luts.update(self.get_equation_luts(state[1]))
+        return luts
+
+    def synthesize_preview(self, factor, position=None, state=None):
+        """
+        Synthesize a low resolution version of a slice from the qmaps downsampled by factor (see
+        Qmap.get_pyramid_level), enlarged back to the slice size. Used while the user drags a parameter.
+        position, state: as in synthesize_slice
+        """
+        if state is None:
+            state = self.get_synthesis_state()
+        map_type, equation, params, values, foreground = state
+        axis, index = self.get_slice_index(position)
+        index = index % foreground.shape[axis]
+        plane = (slice(None),) * axis + (index // factor,)
+
+        mask = self.get_preview_mask(foreground, factor)[plane]
+        inputs = dict()
+        for qmap in equation.direct_qmaps:
+            inputs[qmap] = self._qmaps[qmap].get_map_level(factor)[plane]
+        for qmap in equation.reciprocal_qmaps:
+            inputs[reciprocal_key(qmap)] = self._qmaps[qmap].get_reciprocal_level(factor)[plane]
+        if self._lut_size:
+            for qmap in equation.lut_qmaps:
+                lut = self._qmaps[qmap].get_lut(self._lut_size)[0]
+                inputs[lut_key(qmap)] = self._qmaps[qmap].get_pyramid_level(lut, factor, "lut")[plane]
+
+        synth = equation(compact(inputs, mask), params, luts=self.get_equation_luts(equation))
+        img = self.scale(expand(np.abs(np.nan_to_num(synth)), mask), state)
+        # back to the slice size, then oriented for display
+        shape = foreground.shape[:axis] + foreground.shape[axis + 1:]
+        img = img.repeat(factor, axis=0).repeat(factor, axis=1)[:shape[0], :shape[1]]
+        return np.fliplr(np.rot90(img))
+
+    def get_preview_mask(self, foreground, factor):
+        """
+        Foreground mask downsampled as the qmaps in synthesize_preview.
+        """
+        key = (foreground.mask.key, factor)
+        if self._preview_mask is None or self._preview_mask[0] != key:
+            mask = np.ascontiguousarray(foreground.mask.volume()[::factor, ::factor, ::factor])
+            self._preview_mask = (key, mask)
+        return self._preview_mask[1]
+
+    def synthesize_slice(self, position=None, state=None, term_cache=None):
+        """
+        Synthesize a 2D slice, through the slice cache.
+        position: (orientation, slice number), default the displayed slice
+        state: synthesis state (see get_synthesis_state), default the current one
+        term_cache: TermCache of the displayed slice (GUI thread only)
+        Only reads the qmaps, the foreground and the given state: can run in a worker thread.
+        """
+        if position is None:
+            position = self.get_position()
+        if state is None:
+            state = self.get_synthesis_state()
+        map_type, equation, params, values, foreground = state
+        key = self.get_cache_key(position, state)
+        img = self._slice_cache.get(key)
+        if img is not None:
+            self.touch_memory("slice cache")
+            return img
+
+        # evaluate only the foreground voxels
+        mask = self.get_oriented_mask(foreground.mask, 2, position)
+        qmaps = compact(self.get_equation_inputs(2, position, equation), mask)
+        slice_key = key[3] if term_cache is not None else None
+        values = self._backend.evaluate(equation, qmaps, params, cache=term_cache, slice_key=slice_key,
+                                        luts=self.get_equation_luts(equation))
+        img = self.scale(expand(np.abs(np.nan_to_num(values)), mask), state)
+        self.cache_slice(key, img)
+        return img
+
+    def cache_slice(self, key, img):
+        self._slice_cache.put(key, img)
+        self.track_memory("slice cache", self._slice_cache.nbytes(), self._slice_cache.clear)
+
+    def scale(self, img, state=None):
+        """
+        Scale a synthesized image (slice or volume) to the DICOM range, with the volume scaling of state (default the
+        current one), so that all slices and the 3D export share the same intensities.
+        """
+        scaling, offset = self.get_scaling(state)
+        img = scaling * (img - offset)
+        # the scaling is estimated on a subsample: keep the few brighter voxels in range
+        np.clip(img, 0, self.DICOM_SCALE, out=img)
+        return img.astype(np.float32, copy=False)
+
+    def get_scaling(self, state=None):
+        """
+        Return (scaling, offset) mapping the synthetic values of the whole volume to the DICOM range.
+        Min and max are estimated once per smap type and parameter values, on a strided subsample of the foreground
+        voxels (background voxels are 0).
+        """
+        if state is None:
+            state = self.get_synthesis_state()
+        map_type, equation, params, values, foreground = state
+        key = (map_type, equation, values, foreground.key)
+        try:
+            return self._scaling[key]
+        except KeyError:
+            pass
+
+        qmaps = self.get_sample_inputs(foreground.subsample(self._scaling_samples), equation)
+        synth = np.abs(np.nan_to_num(equation(qmaps, params, luts=self.get_equation_luts(equation))))
+        maxval = synth.max() if synth.size else 0.
+        minval = synth.min() if synth.size else 0.
+        if foreground.size() < foreground.mask.size:
+            minval = min(minval, 0.)
+
+        scaling = self.DICOM_SCALE / (maxval - minval) * 0.1 if maxval > minval else 0.
+        if len(self._scaling) > 1024:
+            self._scaling.clear()
+        self._scaling[key] = (scaling, minval)
+        return scaling, minval
+
+    def get_next_positions(self, direction, count):
+        """
+        Positions of the count slices after the displayed one in direction (+1/-1), wrapping as set_slice_num.
+        """
+        orientation, slice_num = self.get_position()
+        total = self.total_slices_num[orientation]
+        return [(orientation, (slice_num + direction * i) % total) for i in range(1, min(count, total - 1) + 1)]
+
+    def get_synthesis_state(self, map_type=None, equation=None, parameters=None):
+        """
+        Snapshot of what a synthesized slice depends on, besides its position:
+        (smap type, equation, parameter vector, values of the used parameters, foreground).
+        map_type, equation, parameters: another smap to synthesize with the loaded qmaps, default the current one
+        """
+        if map_type is None:
+            map_type, equation, parameters = self.map_type, self._equation, self._parameters
+        params = equation.parameter_vector(parameters)
+        values = tuple(parameters[p]["value"] for p in equation.used_parameters)
+        return map_type, equation, params, values, self.get_foreground()
+
+    def get_foreground(self):
+        """
+        Foreground voxels of the loaded qmaps (see set_mask_options). The store (and the values packed in it) is
+        renewed when a qmap is reloaded, the mask is rebuilt only when its source qmap is reloaded or the mask options
+        change.
+        """
+        source = self.get_mask_source()
+        key = (tuple(self._qmaps[qmap].generation for qmap in self._qmaps), source) + self._mask_options[1:]
+        if self._foreground is None or self._foreground.key != key:
+            mask_key = (source, self._qmaps[source].generation) + self._mask_options[1:]
+            if self._mask is None or self._mask[0].key != mask_key:
+                _, threshold, cleanup = self._mask_options
+                mask = ForegroundMask.from_map(self._qmaps[source], threshold, cleanup, mask_key)
+                self._mask = (mask, np.flatnonzero(mask.volume()))
+            self._foreground = ForegroundVoxels(self._mask[0], key, self._mask[1])
+            self.track_memory("foreground", self._mask[0].nbytes() + self._mask[1].nbytes)
+        return self._foreground
+
+    def get_mask_source(self):
+        """
+        Qmap the foreground mask is thresholded from: the configured one if loaded, else the first loaded qmap.
+        """
+        source = self._mask_options[0]
+        if source in self._qmaps and self._qmaps[source].is_loaded:
+            return source
+        loaded = [qmap for qmap in self._qmaps if self._qmaps[qmap].is_loaded]
+        return loaded[0] if loaded else list(self._qmaps.keys())[0]
+
+    def get_equation_inputs(self, dims=2, position=None, equation=None):
+        """
+        Arrays read by an equation (default the current one): needed qmaps and reciprocal qmaps, for a slice (dims=2,
+        position as in get_oriented_matrix) or the whole volume (dims=3).
+        """
+        if equation is None:
+            equation = self._equation
+        qmaps = dict()
+        for qmap in equation.direct_qmaps:
+            qmaps[qmap] = self._qmaps[qmap].get_matrix(dims, position)
+        for qmap in equation.reciprocal_qmaps:
+            qmaps[reciprocal_key(qmap)] = self._qmaps[qmap].get_reciprocal_matrix(dims, position)
+        if self._lut_size:
+            for qmap in equation.lut_qmaps:
+                qmaps[lut_key(qmap)] = self._qmaps[qmap].get_lut_matrix(dims, self._lut_size, position)
+        return qmaps
+
+    def get_sample_inputs(self, sample, equation):
+        """
+        Inputs of equation (see get_equation_inputs) at the voxels of sample, packed and kept with it. Lazily loaded
+        qmaps are read plane by plane, not in memory.
+        """
+        def values(qmap):
+            return sample.get_packed(qmap, lambda: self._qmaps[qmap].get_values(sample.indices))
+
+        qmaps = dict()
+        for qmap in equation.direct_qmaps:
+            qmaps[qmap] = values(qmap)
+        for qmap in equation.reciprocal_qmaps:
+            qmaps[reciprocal_key(qmap)] = sample.get_packed(reciprocal_key(qmap), lambda: safe_reciprocal(values(qmap)))
+        if self._lut_size:
+            for qmap in equation.lut_qmaps:
+                qmaps[lut_key(qmap)] = sample.pack(lut_key(qmap), self._qmaps[qmap].get_lut_matrix(3, self._lut_size))
+        return qmaps
+
+    def sweep(self, param_matrix, dims=2, roi=None, memory_budget=2 ** 28):
+        """
+        Synthesize the current equation for N parameter settings.
+        param_matrix: (N x n_params) array, columns ordered as the equation parameters
+                      (see get_equation_parameters)
+        dims: 2 for the current slice, 3 for the whole volume
+        roi: optional index (slices or boolean mask) selecting a region of the slice/volume
+        memory_budget: bytes available for temporaries
+        Returns the N unscaled images (absolute value, background set to 0) stacked on the first axis.
+        """
         if self.get_missing_qmaps():
             raise NotLoadedMapError("{} map not laoded!".format(', '.join(self.get_missing_qmaps())))
         if not self._equation:
             raise NotSelectedMapError("Synthetic image not selected!")
 
-        img = eval(self._equation)
-
-        img = np.nan_to_num(img)
-        # automask TODO
-        mask = self.get_mask(dims=dims)
-        img[~mask] = 0
+        foreground = self.get_foreground()
+        mask = self.get_oriented_mask(foreground.mask, dims)
+        inputs = self.get_equation_inputs(dims)
+        if dims == 3 and roi is None:
+            # not kept: a sweep is a one-off
+            qmaps = {k: np.take(inputs[k], foreground.indices) for k in inputs}
+        else:
+            if roi is not None:
+                inputs = {k: inputs[k][roi] for k in inputs}
+                mask = mask[roi]
+            qmaps = compact(inputs, mask)
+        values = np.abs(np.nan_to_num(sweep(self._equation, qmaps, param_matrix, memory_budget)))
+        images = np.zeros((values.shape[0],) + mask.shape, dtype=values.dtype)
+        images[:, mask] = values
+        return images
+
+    def get_equation_parameters(self):
+        return self._equation.parameters
+
+    def get_equation_luts(self, equation=None):
+        """
+        Table values of the qmaps evaluated by lookup, None if table lookup is disabled.
+        """
+        if not self._lut_size:
+            return None
+        if equation is None:
+            equation = self._equation
+        return {qmap: self._qmaps[qmap].get_lut(self._lut_size)[1] for qmap in equation.lut_qmaps}
 
-        # get scaling
-        img = np.abs(img)
-        maxval = img.max()
-        minval = img.min()
+    def get_slice_key(self, position=None):
+        """
+        Identify a slice (default the displayed one): orientation, slice number and loaded version of the needed
+        qmaps.
+        """
+        orientation, slice_num = position if position is not None else self.get_position()
+        generations = tuple(self._qmaps[qmap].generation for qmap in self._qmaps_needed)
+        return orientation, slice_num, generations
 
-        scaling = self.DICOM_SCALE / (maxval - minval) * 0.1
-        offset = minval
+    def get_dependency_state(self):
+        """
+        Everything the displayed 2D image depends on: equation, values of the parameters used by the equation,
+        orientation, slice number and loaded version of the needed qmaps. None if no equation is selected.
+        """
+        if not self._equation:
+            return None
+        values = tuple(self._parameters[p]["value"] for p in self._equation.used_parameters)
+        return self._equation, values, self.get_slice_key()
 
-        if dims == 3:
-            self.np_matrix_3d = (scaling * (img - offset)).astype(np.float32)
-        else:
-            self.np_matrix = (scaling * (img - offset)).astype(np.float32)
+    def get_cache_key(self, position=None, state=None):
+        """
+        Key of a slice in the slice cache: smap type, equation, values of the used parameters, orientation, slice
+        number and loaded version of the qmaps (as recorded in the state foreground).
+        """
+        if state is None:
+            state = self.get_synthesis_state()
+        map_type, equation, params, values, foreground = state
+        orientation, slice_num = position if position is not None else self.get_position()
+        return map_type, equation, values, (orientation, slice_num, foreground.key)
 
     def size(self):
         return self.get_matrix_shape()
@@ -533,7 +1398,7 @@ class Smap(MRIImage):
 
     def save_niftii(self, path):
         self.recompute_smap(dims=3)
-        tmp = self.np_matrix_3d.astype(np.float32)
+        tmp = self.np_matrix_3d.astype(np.float32, copy=False)
         # tmp = np.flip(np.flip(tmp.transpose(), axis=0), axis=1)
 
         niftii = nib.Nifti1Image(tmp, np.eye(4))
@@ -546,7 +1411,9 @@ class Smap(MRIImage):
 
         self.recompute_smap(dims=3)
         # tmp = self.np_matrix_3d.astype(np.short)
-        tmp = np.zeros(self.np_matrix_3d.shape, dtype=np.short)
+        # rows and columns of the stored slices are the second and first axis of the volume (see below)
+        tmp = np.zeros((self.np_matrix_3d.shape[1], self.np_matrix_3d.shape[0], self.np_matrix_3d.shape[2]),
+                       dtype=np.short)
         for i in range(tmp.shape[2]):
             # reorder each 2d image
             tmp[:, :, i] = np.flipud(np.rot90(self.np_matrix_3d[:, :, i], 3)).astype(np.short)
@@ -571,7 +1438,9 @@ class Smap(MRIImage):
                 template[s][tag].value = self._header[tag]
 
             s_relative_idx = s - len(template) / 2.
-            template[s].PixelData = tmp[:, :, s].tobytes()
+            # DICOM templates are read without their pixel data: the element is created with an explicit VR
+            template[s].add_new(0x7FE00010, "OB" if template[s].get("BitsAllocated") == 8 else "OW",
+                                tmp[:, :, s].tobytes())
             save_path = os.path.join(save_dir_path, "series_" + str(s + 1) + ".dcm")
             template[s].WindowCenter = self.get_window_center()
             template[s].WindowWidth = self.get_window_width()
@@ -0,0 +1,151 @@
+"""
+Index of the DICOM series found below a study folder.
+
+A folder exported from a PACS may hold many series, and files that are not DICOM. DicomIndex reads the header of each
+file once (pixel data skipped) and records its series (SeriesInstanceUID, SeriesDescription, SeriesNumber) and slice
+location in a small JSON file kept in the index directory ("dicom_index_dir" key of the "loading" configuration
+section, empty: ~/.pySynthMRI/dicom_index). Later scans only read the files added or modified (size or modification
+time changed) since the last one.
+
+A qmap series is selected by matching its SeriesDescription with the "series_description" pattern of the qmap in the
+"quantitative_maps" configuration section (shell-style wildcards, case insensitive, e.g. "*T1*map*").
+"""
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+import pydicom
+
+from src.model.psDicomReader import run_concurrently, get_location
+
+log = logging.getLogger(__name__)
+
+# index file format
+FORMAT = 1
+# header elements read for the index
+INDEX_TAGS = ["SeriesInstanceUID", "SeriesDescription", "SeriesNumber", "SliceLocation", "ImagePositionPatient"]
+
+# a series of the index: files sorted by slice location
+Series = namedtuple("Series", ["uid", "description", "number", "files"])
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser("~"), ".pySynthMRI", "dicom_index")
+
+
+def read_entry(fname):
+    """
+    Index entry of a file: series UID, description, number and slice location. UID None if it is not DICOM.
+    """
+    try:
+        header = pydicom.dcmread(fname, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+        uid = str(header.SeriesInstanceUID)
+    except Exception:
+        return [None, "", None, None]
+    number = int(header.SeriesNumber) if header.get("SeriesNumber") not in (None, "") else None
+    return [uid, str(header.get("SeriesDescription", "")), number, get_location(header)]
+
+
+class DicomIndex:
+    """
+    DICOM series below root.
+    root: study folder
+    directory: where the index file is kept (default ~/.pySynthMRI/dicom_index)
+    """
+    # root -> lock: the qmaps of a study loaded concurrently update its index one at a time
+    _locks = dict()
+    _locks_lock = threading.Lock()
+
+    def __init__(self, root, directory=""):
+        self.root = os.path.abspath(str(root))
+        self.directory = directory or default_directory()
+        name = hashlib.blake2b(self.root.encode(), digest_size=16).hexdigest()
+        self.index_path = os.path.join(self.directory, name + ".json")
+        # relative path -> [size, mtime, series UID, description, number, location]
+        self.files = dict()
+        with self._locks_lock:
+            self._lock = self._locks.setdefault(self.root, threading.Lock())
+
+    def load(self):
+        try:
+            with open(self.index_path) as fd:
+                index = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if index.get("format") == FORMAT and index.get("root") == self.root:
+            self.files = index["files"]
+
+    def save(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(self.index_path, threading.get_ident())
+            with open(tmp_path, "w") as fd:
+                json.dump({"format": FORMAT, "root": self.root, "files": self.files}, fd)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            log.warning("DicomIndex: cannot save the index of {}: {}".format(self.root, e))
+
+    def update(self, workers=0, progress=None):
+        """
+        Load the index and bring it up to date: files added or modified since the last scan are read, removed files
+        dropped. workers and progress as in psDicomReader.run_concurrently (progress over the files to read).
+        Returns the number of files read.
+        """
+        with self._lock:
+            self.load()
+            current = dict()
+            for root, _, names in os.walk(self.root):
+                for name in names:
+                    fname = os.path.join(root, name)
+                    stat = os.stat(fname)
+                    current[os.path.relpath(fname, self.root)] = [stat.st_size, stat.st_mtime_ns]
+            files = {k: v for k, v in self.files.items() if k in current and v[:2] == current[k]}
+            changed = sorted(k for k in current if k not in files)
+            if changed or len(files) != len(self.files):
+                entries = run_concurrently(read_entry, [os.path.join(self.root, k) for k in changed], workers, progress)
+                for k, entry in zip(changed, entries):
+                    files[k] = current[k] + entry
+                self.files = files
+                self.save()
+            log.debug("DicomIndex: {} files in {}, {} read".format(len(self.files), self.root, len(changed)))
+            return len(changed)
+
+    def series(self):
+        """
+        List the series of the index, sorted by series number and description.
+        """
+        series = dict()
+        for k, (_, _, uid, description, number, location) in self.files.items():
+            if uid is None:
+                continue
+            series.setdefault(uid, (description, number, []))[2].append((location, k))
+        found = []
+        for uid, (description, number, files) in series.items():
+            files = sorted(files, key=lambda f: (f[0] is None, f[0] if f[0] is not None else 0., f[1]))
+            found.append(Series(uid, description, number, [os.path.join(self.root, f[1]) for f in files]))
+        return sorted(found, key=lambda s: (s.number is None, s.number or 0, s.description))
+
+    def find(self, pattern=""):
+        """
+        List the series whose SeriesDescription matches pattern (shell-style wildcards, case insensitive), all of
+        them if pattern is empty.
+        """
+        return [s for s in self.series() if not pattern or fnmatch.fnmatch(s.description.lower(), pattern.lower())]
+
+    def select(self, pattern=""):
+        """
+        Return the only series matching pattern (see find). Raises ValueError if none or more than one match.
+        """
+        found = self.find(pattern)
+        if len(found) == 1:
+            return found[0]
+        if not found:
+            raise ValueError("No DICOM series{} in {}.".format(
+                " matching {}".format(pattern) if pattern else "", self.root))
+        raise ValueError("{} DICOM series{} in {}: {}. Set series_description to choose one.".format(
+            len(found), " matching {}".format(pattern) if pattern else "", self.root,
+            ", ".join(s.description or s.uid for s in found)))
@@ -0,0 +1,130 @@
+"""
+Concurrent reading of the DICOM files of a qmap.
+
+A series is loaded in two passes, both run on a pool of "dicom_workers" threads (0: one per CPU), set in the "loading"
+section of the configuration file. File reading and the pixel decoders release the GIL, so the files are parsed in
+parallel:
+    read_headers: read the headers only (pixel data skipped), sort the slices and check that they share the same
+                  geometry, which sizes the output volume
+    read_pixels: decode the pixel data of each file straight into its plane of a volume preallocated in the native
+                 (integer) type of the series
+RescaleSlope and RescaleIntercept are not applied while decoding: see get_rescale.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pydicom
+
+log = logging.getLogger(__name__)
+
+
+def run_concurrently(function, items, workers=0, progress=None):
+    """
+    Call function on each item on a pool of workers threads (0: one per CPU).
+    progress: optional callable(done, total), called from the calling thread after each item
+    Returns the results in the order of items. The first error raised by an item is re-raised, with the remaining
+    items cancelled.
+    """
+    workers = workers if workers > 0 else (os.cpu_count() or 1)
+    workers = max(1, min(workers, len(items)))
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dicom") as executor:
+        futures = {executor.submit(function, item): i for i, item in enumerate(items)}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress(done, len(items))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+def read_header(fname):
+    return pydicom.dcmread(fname, stop_before_pixels=True)
+
+
+def get_location(header):
+    """
+    Location of the slice of header: SliceLocation (optional), else the z of ImagePositionPatient. None if both are
+    missing.
+    """
+    if "SliceLocation" in header:
+        return float(header.SliceLocation)
+    if "ImagePositionPatient" in header:
+        return float(header.ImagePositionPatient[2])
+    return None
+
+
+def read_headers(file_list, workers=0, progress=None):
+    """
+    Read the headers of file_list (see run_concurrently). Returns them sorted by location (see get_location), each
+    with the filename it was read from. Raises ValueError if a file has no location.
+    """
+    headers = run_concurrently(read_header, file_list, workers, progress)
+    log.debug("read_headers: {} files".format(len(headers)))
+    for header in headers:
+        if get_location(header) is None:
+            raise ValueError("DICOM file {} has neither SliceLocation nor ImagePositionPatient.".format(
+                header.filename))
+    # ensure they are in the correct order
+    return sorted(headers, key=get_location)
+
+
+def get_dtype(header):
+    """
+    Native type of the pixel data described by header.
+    """
+    kind = "i" if header.PixelRepresentation else "u"
+    return np.dtype("{}{}".format(kind, header.BitsAllocated // 8))
+
+
+def check_geometry(headers):
+    """
+    Check that the sorted headers describe a single stack of equal, single channel images.
+    Returns the shape (slices, rows, columns) and the native type of the pixel data, raises ValueError otherwise.
+    """
+    if not headers:
+        raise ValueError("No DICOM files found.")
+    first = headers[0]
+    if getattr(first, "SamplesPerPixel", 1) != 1:
+        raise ValueError("DICOM images must be single channel, {} has {}.".format(first.filename,
+                                                                                    first.SamplesPerPixel))
+    geometry = (first.Rows, first.Columns, list(first.PixelSpacing), get_dtype(first))
+    for header in headers[1:]:
+        if (header.Rows, header.Columns, list(header.PixelSpacing), get_dtype(header)) != geometry:
+            raise ValueError("DICOM file {} does not match the geometry of {}.".format(header.filename,
+                                                                                      first.filename))
+    locations = np.array([get_location(h) for h in headers])
+    if np.any(np.diff(locations) == 0):
+        raise ValueError("DICOM files with the same location in {}.".format(os.path.dirname(first.filename)))
+    return (len(headers), first.Rows, first.Columns), geometry[3]
+
+
+def read_pixels(headers, out, workers=0, progress=None):
+    """
+    Decode the pixel data of the files of the sorted headers into out[i] (see run_concurrently).
+    out: (slices, rows, columns) array in the native type of the series
+    """
+
+    def read(i):
+        out[i] = pydicom.dcmread(headers[i].filename).pixel_array
+
+    run_concurrently(read, range(len(headers)), workers, progress)
+    log.debug("read_pixels: {} planes of {}".format(len(headers), out.dtype))
+
+
+def get_rescale(headers):
+    """
+    RescaleSlope and RescaleIntercept of each of the sorted headers, as arrays, or None if they leave the stored
+    values unchanged (the conversion to real values can then be skipped).
+    """
+    slope = np.array([float(getattr(h, "RescaleSlope", 1.)) for h in headers])
+    intercept = np.array([float(getattr(h, "RescaleIntercept", 0.)) for h in headers])
+    if np.all(slope == 1.) and np.all(intercept == 0.):
+        return None
+    return slope, intercept
@@ -0,0 +1,619 @@
+"""
+Compiler for the synthetic image equations defined in the configuration file.
+
+Each equation string (e.g. "PD*((1 - exp(-TR/T1))*exp(-TE/T2))") is parsed once, when the configuration is
+loaded, into a graph of nodes. Only arithmetic operators, numeric constants, scanner parameters, quantitative maps
+and a whitelist of functions are accepted. The result is a CompiledEquation: a callable that takes the qmap arrays
+and the parameter vector and returns the synthesized image, without re-parsing the equation on each recompute.
+
+Identical sub-terms are shared (e.g. a repeated exp(-TI/T1) is evaluated once) and multiplication chains are
+grouped by the scanner parameters their factors depend on. Passing a TermCache to the equation keeps the sub-term
+arrays of the current slice, so that only the terms depending on a changed parameter are recomputed.
+Divisions by a quantitative map (e.g. -TE/T2) are compiled as multiplications by the reciprocal map, which the
+caller can provide precomputed (see Qmap.get_reciprocal_matrix) under the reciprocal_key of the map.
+
+evaluate_many evaluates several equations (e.g. all the contrasts of a preset) on the same inputs in one pass, sharing
+the sub-terms with the same structure and the same parameter values across equations.
+
+Terms depending on a single map and containing a function (e.g. 1-2*exp(-TI/T1)) can be evaluated by table lookup:
+the map is quantized once (build_lut), the term is evaluated on the table values for the current parameters and
+the image is gathered from the table with the quantized map, instead of calling exp on each voxel.
+"""
+import ast
+import logging
+
+import numpy as np
+
+from src.model.psExceptions import EquationError
+from src.model.utils import safe_reciprocal
+
+log = logging.getLogger(__name__)
+
+# functions that can be used inside an equation
+FUNCTIONS = {
+    "exp": np.exp,
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "cos": np.cos,
+    "sin": np.sin,
+    "tan": np.tan,
+}
+
+# named constants that can be used inside an equation
+CONSTANTS = {
+    "Pi": np.pi,
+}
+
+BINARY_OPERATORS = {
+    ast.Add: ("+", np.add),
+    ast.Sub: ("-", np.subtract),
+    ast.Div: ("/", np.true_divide),
+    ast.Pow: ("**", np.power),
+}
+
+UNARY_OPERATORS = {
+    ast.USub: ("-", np.negative),
+    ast.UAdd: ("+", np.positive),
+}
+
+
+class Node:
+    """
+    Single term of a compiled equation.
+    key: structural key, equal for identical sub-terms
+    params: names of the scanner parameters the term depends on
+    maps: names of the quantitative maps the term depends on (a term without maps is a scalar)
+    """
+    key = None
+    params = frozenset()
+    maps = frozenset()
+
+    def children(self):
+        return ()
+
+    def compute(self, evaluation):
+        raise NotImplementedError
+
+    def is_array(self):
+        return bool(self.maps)
+
+
+class Constant(Node):
+    def __init__(self, value):
+        self.value = value
+        self.key = ("const", value)
+
+    def compute(self, evaluation):
+        return self.value
+
+
+class Parameter(Node):
+    def __init__(self, name):
+        self.name = name
+        self.key = ("param", name)
+        self.params = frozenset([name])
+
+    def compute(self, evaluation):
+        return evaluation.values[self.name]
+
+
+class Map(Node):
+    def __init__(self, name):
+        self.name = name
+        self.key = ("map", name)
+        self.maps = frozenset([name])
+
+    def compute(self, evaluation):
+        return evaluation.maps[self.name]
+
+
+def reciprocal_key(qmap):
+    """
+    Name of the input holding 1/qmap.
+    """
+    return "1/" + qmap
+
+
+class Reciprocal(Node):
+    """
+    1/map, read from the inputs if available, otherwise computed (inf where the map is 0, as in a division).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = ("reciprocal", name)
+        self.maps = frozenset([name])
+
+    def compute(self, evaluation):
+        try:
+            return evaluation.maps[reciprocal_key(self.name)]
+        except KeyError:
+            return safe_reciprocal(evaluation.maps[self.name])
+
+
+def lut_key(qmap):
+    """
+    Name of the input holding the quantized qmap (table indexes).
+    """
+    return "lut/" + qmap
+
+
+def build_lut(np_matrix, size):
+    """
+    Quantize a relaxation map for table lookup.
+    Index 0 holds non positive and non finite voxels (value 0), indexes 1..size-1 are log-spaced between the smallest
+    and the largest positive value, so that the relative quantization error is the same on the whole range.
+    Returns (index volume, values of the map for each index, max relative quantization error).
+    A map read in parts is quantized with the range of the part ranges: see lut_range, lut_grid and lut_index.
+    """
+    value_range = lut_range(np_matrix)
+    grid, error = lut_grid(value_range, size, np_matrix.dtype)
+    return lut_index(np_matrix, value_range, size), grid, error
+
+
+def lut_range(np_matrix):
+    """
+    Smallest and largest positive finite values of np_matrix, None if there are none.
+    """
+    valid = np.isfinite(np_matrix) & (np_matrix > 0)
+    if not valid.any():
+        return None
+    return np_matrix[valid].min(), np_matrix[valid].max()
+
+
+def lut_step(value_range, size):
+    low, high = value_range
+    log_low = np.log(low)
+    return log_low, (np.log(high) - log_low) / (size - 2)
+
+
+def lut_grid(value_range, size, dtype):
+    """
+    Table values for the value_range of the map (see lut_range) and max relative quantization error.
+    """
+    grid = np.zeros(size, dtype=dtype)
+    if value_range is None:
+        return grid, 0.
+    if value_range[0] == value_range[1]:
+        grid[1] = value_range[0]
+        return grid, 0.
+    log_low, step = lut_step(value_range, size)
+    grid[1:] = np.exp(log_low + step * np.arange(size - 1))
+    return grid, float(np.expm1(step / 2))
+
+
+def lut_index(np_matrix, value_range, size):
+    """
+    Table indexes of the voxels of np_matrix, the whole map or a part of it, for the value_range of the map.
+    """
+    index = np.zeros(np_matrix.shape, dtype=np.uint16)
+    if value_range is None:
+        return index
+    valid = np.isfinite(np_matrix) & (np_matrix > 0)
+    if value_range[0] == value_range[1]:
+        index[valid] = 1
+        return index
+    log_low, step = lut_step(value_range, size)
+    index[valid] = np.clip(np.rint((np.log(np_matrix[valid]) - log_low) / step) + 1, 1, size - 1)
+    return index
+
+
+class Unary(Node):
+    def __init__(self, symbol, function, child):
+        self.symbol = symbol
+        self.function = function
+        self.child = child
+        self.key = ("unary", symbol, child.key)
+        self.params = child.params
+        self.maps = child.maps
+
+    def children(self):
+        return (self.child,)
+
+    def compute(self, evaluation):
+        return self.function(evaluation.value(self.child))
+
+
+class Binary(Node):
+    def __init__(self, symbol, function, left, right):
+        self.symbol = symbol
+        self.function = function
+        self.left = left
+        self.right = right
+        self.key = ("binary", symbol, left.key, right.key)
+        self.params = left.params | right.params
+        self.maps = left.maps | right.maps
+
+    def children(self):
+        return self.left, self.right
+
+    def compute(self, evaluation):
+        return self.function(evaluation.value(self.left), evaluation.value(self.right))
+
+
+class Product(Node):
+    """
+    Product of several factors. Scalar factors are multiplied together before touching any array.
+    When evaluated with a TermCache, the product of the factors not affected by the last parameter change is kept,
+    so that dragging a single parameter costs a single multiplication.
+    """
+
+    def __init__(self, factors):
+        self.factors = tuple(factors)
+        self.key = ("product",) + tuple(sorted((f.key for f in self.factors), key=repr))
+        self.params = frozenset().union(*[f.params for f in self.factors])
+        self.maps = frozenset().union(*[f.maps for f in self.factors])
+
+    def children(self):
+        return self.factors
+
+    @staticmethod
+    def multiply(values):
+        scalar = 1.
+        arrays = []
+        for value in values:
+            if np.ndim(value) == 0:
+                scalar = scalar * value
+            else:
+                arrays.append(value)
+        if not arrays:
+            return scalar
+        result = arrays[0] * scalar if scalar != 1. else arrays[0]
+        for array in arrays[1:]:
+            result = result * array
+        return result
+
+    def compute(self, evaluation):
+        cache = evaluation.cache
+        if cache is None or not self.is_array():
+            return self.multiply([evaluation.value(f) for f in self.factors])
+
+        partial = cache.get_partial(self, evaluation.values)
+        if partial is not None:
+            included, value = partial
+            others = [evaluation.value(f) for f in self.factors if f not in included]
+            return self.multiply([value] + others)
+
+        # keep the factors not affected by the last change
+        included = [f for f in self.factors if not (f.params & cache.changed)]
+        excluded = [f for f in self.factors if f not in included]
+        value = self.multiply([evaluation.value(f) for f in included])
+        if excluded and included and np.ndim(value) != 0:
+            cache.set_partial(self, included, evaluation.values, value)
+        return self.multiply([value] + [evaluation.value(f) for f in excluded])
+
+
+class TermCache:
+    """
+    Sub-term arrays of the last evaluated slice.
+    Each entry is stored with the values of the parameters it depends on and is reused while they do not change.
+    The cache is emptied when the slice (or the equation) changes.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._entries = dict()
+        self._partials = dict()
+        self._slice_key = None
+        self._equation = None
+        self._last_values = dict()
+        self.changed = frozenset()
+
+    def begin(self, equation, slice_key, values):
+        """
+        Start a new evaluation of equation on the slice identified by slice_key with parameter values.
+        """
+        if equation is not self._equation or slice_key != self._slice_key:
+            self.clear()
+            self._equation = equation
+            self._slice_key = slice_key
+        self.changed = frozenset(p for p in values if self._last_values.get(p) != values[p])
+        self._last_values = dict(values)
+
+    @staticmethod
+    def _key(node, values):
+        return tuple(values[p] for p in sorted(node.params))
+
+    def get(self, node, values):
+        try:
+            key, value = self._entries[node]
+        except KeyError:
+            return None
+        if key != self._key(node, values):
+            return None
+        return value
+
+    def set(self, node, values, value):
+        self._entries[node] = (self._key(node, values), value)
+
+    def get_partial(self, node, values):
+        try:
+            included, key, value = self._partials[node]
+        except KeyError:
+            return None
+        if key != tuple(self._key(f, values) for f in included):
+            return None
+        return included, value
+
+    def set_partial(self, node, included, values, value):
+        included = tuple(included)
+        self._partials[node] = (included, tuple(self._key(f, values) for f in included), value)
+
+
+class Evaluation:
+    """
+    State of a single evaluation of an equation: inputs, parameter values, shared sub-term results.
+    """
+
+    def __init__(self, equation, maps, values, cache=None, luts=None, shared=None):
+        self.equation = equation
+        self.maps = maps
+        self.values = values
+        self.cache = cache
+        self.luts = luts
+        # sub-term results shared with the evaluations of other equations (see evaluate_many)
+        self.shared = shared
+        self._memo = dict()
+
+    def value(self, node):
+        try:
+            return self._memo[node]
+        except KeyError:
+            pass
+        if self.shared is not None:
+            shared_key = (node.key, TermCache._key(node, self.values))
+            try:
+                value = self._memo[node] = self.shared[shared_key]
+                return value
+            except KeyError:
+                pass
+        cached = self.cache is not None and node in self.equation.cached_terms
+        value = self.cache.get(node, self.values) if cached else None
+        if value is None:
+            if self.luts is not None and node in self.equation.lut_terms:
+                value = self._lookup(node)
+            else:
+                value = node.compute(self)
+            if cached:
+                self.cache.set(node, self.values, value)
+        self._memo[node] = value
+        if self.shared is not None:
+            self.shared[shared_key] = value
+        return value
+
+    def _lookup(self, node):
+        # evaluate the term on the table values of its map, then gather
+        qmap = next(iter(node.maps))
+        grid = self.luts[qmap]
+        table = Evaluation(self.equation, {qmap: grid, reciprocal_key(qmap): safe_reciprocal(grid)},
+                           self.values).value(node)
+        table = np.broadcast_to(table, grid.shape)
+        return np.take(table, self.maps[lut_key(qmap)])
+
+
+def evaluate_many(equations, maps, params_list, luts=None):
+    """
+    Evaluate several equations on the same inputs, computing once the sub-terms they have in common (same structure
+    and same values of the parameters they depend on, e.g. exp(-TR/T1) of two contrasts with the same TR).
+    equations: CompiledEquation list
+    maps: inputs of all the equations
+    params_list: parameter vector of each equation
+    Returns the list of the results.
+    """
+    shared = dict()
+    results = []
+    for equation, params in zip(equations, params_list):
+        values = dict(zip(equation.parameters, params))
+        results.append(Evaluation(equation, maps, values, luts=luts, shared=shared).value(equation.root))
+    return results
+
+
+class CompiledEquation:
+    """
+    Callable version of a configuration equation.
+    source: equation as written in the configuration file
+    parameters: scanner parameter names, in the order expected by the parameter vector
+    qmaps: quantitative map names needed by the equation
+    used_parameters: scanner parameters that actually appear in the equation (the image depends only on these)
+    lut_qmaps: quantitative maps whose single-map terms can be evaluated by table lookup
+    """
+
+    def __init__(self, source, root, parameters, qmaps):
+        self.source = source
+        self.root = root
+        self.parameters = tuple(parameters)
+        self.qmaps = tuple(qmaps)
+        self.used_parameters = tuple(p for p in self.parameters if p in root.params)
+        self.cached_terms = self._find_cached_terms(root)
+        # inputs read by the equation: maps used as they are and maps used through their reciprocal
+        leaves = self._find_leaves(root)
+        self.direct_qmaps = tuple(q for q in self.qmaps if ("map", q) in leaves)
+        self.reciprocal_qmaps = tuple(q for q in self.qmaps if ("reciprocal", q) in leaves)
+        self.lut_terms = self._find_lut_terms(root)
+        # number of distinct terms producing an array (upper bound of the temporaries of an evaluation)
+        self.array_terms = sum(1 for node in self._find_nodes(root) if node.is_array())
+        self.lut_qmaps = tuple(q for q in self.qmaps if any(q in t.maps for t in self.lut_terms))
+
+    @staticmethod
+    def _find_lut_terms(root):
+        """
+        Largest terms depending on a single map and containing at least one transcendental function call.
+        """
+        def has_function(node):
+            return (isinstance(node, Unary) and node.symbol in FUNCTIONS and node.symbol != "abs") or any(
+                has_function(c) for c in node.children())
+
+        lut_terms = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if len(node.maps) == 1 and has_function(node):
+                lut_terms.add(node)
+            else:
+                stack.extend(node.children())
+        return frozenset(lut_terms)
+
+    @staticmethod
+    def _find_nodes(root):
+        nodes = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node not in nodes:
+                nodes.add(node)
+                stack.extend(node.children())
+        return nodes
+
+    @classmethod
+    def _find_leaves(cls, root):
+        return set(node.key for node in cls._find_nodes(root) if isinstance(node, (Map, Reciprocal)))
+
+    @staticmethod
+    def _find_cached_terms(root):
+        """
+        Terms worth caching: array terms that depend on fewer parameters than the term using them.
+        Single maps are already available and are never cached.
+        """
+        cached_terms = set()
+        visited = set()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+            for child in node.children():
+                if child.is_array() and not isinstance(child, (Map, Reciprocal)) and child.params != node.params:
+                    cached_terms.add(child)
+                stack.append(child)
+        return frozenset(cached_terms)
+
+    def __call__(self, maps, params, cache=None, slice_key=None, luts=None):
+        """
+        Synthesize the image.
+        maps: dictionary qmap name -> numpy array (all arrays with the same shape). For the maps in
+              reciprocal_qmaps, the precomputed reciprocal can be given under reciprocal_key(qmap)
+        params: parameter values, ordered as self.parameters
+        cache: optional TermCache, reused across calls on the same slice
+        slice_key: identifier of the slice the maps belong to (needed with cache)
+        luts: optional dictionary qmap name -> table values (see build_lut) for the maps in lut_qmaps; the
+              quantized maps are read from maps under lut_key(qmap)
+        """
+        if len(params) != len(self.parameters):
+            raise EquationError("Equation {} expects {} parameters, {} given.".format(
+                self.source, len(self.parameters), len(params)))
+        values = dict(zip(self.parameters, params))
+        if cache is not None:
+            cache.begin(self, slice_key, values)
+        return Evaluation(self, maps, values, cache, luts).value(self.root)
+
+    def parameter_vector(self, parameters):
+        """
+        Build the parameter vector from the smap parameters structure ({name: {"value": ...}}).
+        """
+        return [parameters[p]["value"] for p in self.parameters]
+
+    def __str__(self):
+        return self.source
+
+
+class EquationCompiler:
+    """
+    Parse and validate equation strings against the known scanner parameters and quantitative maps.
+    """
+
+    def __init__(self, qmap_types):
+        self.qmap_types = list(qmap_types)
+        self._nodes = dict()
+
+    def compile(self, equation, parameters, label=""):
+        """
+        Compile an equation string.
+        equation: equation string (e.g. "PD*exp(-TE/T2)")
+        parameters: scanner parameter names usable in the equation
+        label: name of the synthetic map, used in error messages
+        """
+        try:
+            tree = ast.parse(equation.strip(), mode="eval")
+        except SyntaxError as e:
+            raise EquationError("Check syntax of {} equation: {}".format(label, e.msg))
+
+        parameters = list(parameters)
+        root = self._build(tree.body, parameters, label)
+        # keep config order for the needed qmaps
+        qmaps_needed = [q for q in self.qmap_types if q in root.maps]
+        log.debug("compile: {} -> params {} qmaps {}".format(label, parameters, qmaps_needed))
+        return CompiledEquation(equation, root, parameters, qmaps_needed)
+
+    def _shared(self, node):
+        # common sub-expressions: identical terms are the same node
+        return self._nodes.setdefault(node.key, node)
+
+    def _product(self, factors):
+        # group the factors by the parameters they depend on
+        groups = dict()
+        for factor in factors:
+            groups.setdefault(factor.params, []).append(factor)
+        grouped = []
+        for params in groups:
+            group = groups[params]
+            grouped.append(group[0] if len(group) == 1 else self._shared(Product(group)))
+        if len(grouped) == 1:
+            return grouped[0]
+        return self._shared(Product(grouped))
+
+    def _factors(self, node, parameters, label):
+        # flatten a chain of multiplications
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+            return self._factors(node.left, parameters, label) + self._factors(node.right, parameters, label)
+        return self._flatten(self._build(node, parameters, label))
+
+    @staticmethod
+    def _flatten(node):
+        if isinstance(node, Product):
+            return list(node.factors)
+        return [node]
+
+    def _build(self, node, parameters, label):
+        if isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Mult):
+                return self._product(self._factors(node, parameters, label))
+            if type(node.op) not in BINARY_OPERATORS:
+                raise EquationError("Operator not allowed in {} equation.".format(label))
+            symbol, function = BINARY_OPERATORS[type(node.op)]
+            left = self._build(node.left, parameters, label)
+            right = self._build(node.right, parameters, label)
+            if isinstance(node.op, ast.Div) and isinstance(right, Map):
+                # x/T1 -> x*(1/T1): no array division at each recompute
+                return self._product(self._flatten(left) + [self._shared(Reciprocal(right.name))])
+            return self._shared(Binary(symbol, function, left, right))
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in UNARY_OPERATORS:
+                raise EquationError("Operator not allowed in {} equation.".format(label))
+            symbol, function = UNARY_OPERATORS[type(node.op)]
+            return self._shared(Unary(symbol, function, self._build(node.operand, parameters, label)))
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                raise EquationError("Function not allowed in {} equation. Allowed: {}".format(
+                    label, ", ".join(FUNCTIONS)))
+            if len(node.args) != 1 or node.keywords:
+                raise EquationError("Function {} takes exactly one argument in {} equation.".format(
+                    node.func.id, label))
+            return self._shared(Unary(node.func.id, FUNCTIONS[node.func.id],
+                                      self._build(node.args[0], parameters, label)))
+        elif isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise EquationError("Only numeric constants allowed in {} equation.".format(label))
+            return self._shared(Constant(node.value))
+        elif isinstance(node, ast.Name):
+            # scanner parameters have priority over qmaps
+            if node.id in parameters:
+                return self._shared(Parameter(node.id))
+            if node.id in self.qmap_types:
+                return self._shared(Map(node.id))
+            if node.id in CONSTANTS:
+                return self._shared(Constant(CONSTANTS[node.id]))
+            raise EquationError("Unknown symbol {} in {} equation.".format(node.id, label))
+        raise EquationError("Expression not allowed in {} equation.".format(label))
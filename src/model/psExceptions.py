@@ -29,3 +29,14 @@ class ConfigurationFilePermissionError(Exception):
     def __init__(self, message="Error accessing configuration file. "):
         self.message = message
         super().__init__(self.message)
+
+
+class EquationError(Exception):
+    """Exception raised when a synthetic image equation cannot be compiled or evaluated
+    Parameters:
+        message: explanation of the error
+    """
+
+    def __init__(self, message="Invalid equation"):
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,88 @@
+"""
+Compact representation of the foreground voxels of a loaded subject.
+
+In head scans most of the grid is air: the synthetic equations are evaluated only on the voxels inside the mask and
+the result is scattered back into the slice or the volume.
+"""
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class ForegroundVoxels:
+    """
+    Foreground voxels of a subject.
+    mask: ForegroundMask
+    key: identifies the loaded qmaps the store was built from
+    indices: flat (C order) indices of the foreground voxels in the volume, default all (see subsample)
+    Packed 1-D values of the synthesis inputs (qmaps, reciprocal maps, ...) are built on first request and kept with
+    the store: the subsample estimating the volume scaling (see Smap.get_scaling). Whole volumes are synthesized chunk
+    by chunk instead (see Smap.synthesize_volumes).
+    """
+
+    def __init__(self, mask, key=None, indices=None):
+        self.key = key
+        self.mask = mask
+        self.shape = mask.shape
+        self.indices = np.flatnonzero(mask.volume()) if indices is None else indices
+        self._packed = dict()
+        self._subsamples = dict()
+        log.debug("ForegroundVoxels: {} of {} voxels".format(self.indices.size, mask.size))
+
+    def size(self):
+        return self.indices.size
+
+    def subsample(self, count):
+        """
+        Return about count foreground voxels taken with a regular stride (all of them if count is 0), as a
+        ForegroundVoxels kept with this store.
+        """
+        step = self.indices.size // count if count else 1
+        if step <= 1:
+            return self
+        try:
+            return self._subsamples[step]
+        except KeyError:
+            pass
+        sample = ForegroundVoxels(self.mask, self.key, self.indices[::step])
+        self._subsamples[step] = sample
+        return sample
+
+    def pack(self, name, volume):
+        """
+        Return the foreground values of volume, packed in a 1-D array, cached under name.
+        """
+        return self.get_packed(name, lambda: np.take(volume, self.indices))
+
+    def get_packed(self, name, read):
+        """
+        Return the packed values cached under name, computed by read() (values at indices, as a 1-D array) on first
+        request.
+        """
+        try:
+            return self._packed[name]
+        except KeyError:
+            pass
+        packed = read()
+        self._packed[name] = packed
+        return packed
+
+
+def compact(arrays, mask):
+    """
+    Select the voxels inside mask from each array of a dictionary name -> array (e.g. the current slice inputs).
+    """
+    return {name: arrays[name][mask] for name in arrays}
+
+
+def expand(values, mask, dtype=None):
+    """
+    Put values computed on the voxels inside mask back in an array shaped as mask, other voxels set to 0.
+    """
+    if dtype is None:
+        dtype = np.result_type(values, np.float32)
+    out = np.zeros(mask.shape, dtype=dtype)
+    out[mask] = values
+    return out
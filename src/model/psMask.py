@@ -0,0 +1,101 @@
+"""
+Foreground mask of the loaded subject.
+
+The mask is thresholded once from a source qmap ("mask_source" and "mask_threshold" keys of the "synthesis"
+configuration section), optionally cleaned with a morphological opening and closing of "mask_cleanup" iterations, and
+kept as a packed bit volume (one bit per voxel). Oriented slices are unpacked on request.
+"""
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class ForegroundMask:
+    """
+    Boolean volume packed along the first axis.
+    volume: boolean 3D array
+    key: identifies the source qmap version and the options the mask was built from
+    """
+
+    def __init__(self, volume, key=None):
+        self.key = key
+        self.shape = volume.shape
+        self.size = volume.size
+        self._bits = np.packbits(volume, axis=0)
+        log.debug("ForegroundMask: {} voxels packed in {} bytes".format(volume.size, self._bits.nbytes))
+
+    @classmethod
+    def from_map(cls, qmap, threshold=0.01, cleanup=0, key=None):
+        """
+        Build the mask of the voxels of qmap above threshold (see Qmap.get_threshold_mask), cleaned with cleanup
+        iterations of opening and closing (0: no cleanup).
+        """
+        volume = qmap.get_threshold_mask(threshold)
+        if cleanup:
+            volume = binary_closing(binary_opening(volume, cleanup), cleanup)
+        return cls(volume, key)
+
+    def volume(self):
+        """
+        Return the unpacked boolean volume.
+        """
+        return np.unpackbits(self._bits, axis=0, count=self.shape[0]).view(bool)
+
+    def plane(self, axis, index):
+        """
+        Return the (not oriented) plane index of the volume across axis, as in volume()[:, :, index] for axis 2.
+        """
+        if axis == 0:
+            return ((self._bits[index // 8] >> (7 - index % 8)) & 1).view(bool)
+        if axis == 1:
+            return np.unpackbits(self._bits[:, index, :], axis=0, count=self.shape[0]).view(bool)
+        return np.unpackbits(self._bits[:, :, index], axis=0, count=self.shape[0]).view(bool)
+
+    def nbytes(self):
+        return self._bits.nbytes
+
+
+def binary_erosion(volume, iterations=1):
+    """
+    Erode a boolean volume with the 6-connected structuring element. Voxels outside the volume are background.
+    """
+    for _ in range(iterations):
+        padded = np.pad(volume, 1, constant_values=False)
+        volume = volume.copy()
+        for axis in range(volume.ndim):
+            for shift in (0, 2):
+                index = [slice(1, -1)] * volume.ndim
+                index[axis] = slice(shift, shift + volume.shape[axis])
+                volume &= padded[tuple(index)]
+    return volume
+
+
+def binary_dilation(volume, iterations=1):
+    """
+    Dilate a boolean volume with the 6-connected structuring element.
+    """
+    for _ in range(iterations):
+        padded = np.pad(volume, 1, constant_values=False)
+        volume = volume.copy()
+        for axis in range(volume.ndim):
+            for shift in (0, 2):
+                index = [slice(1, -1)] * volume.ndim
+                index[axis] = slice(shift, shift + volume.shape[axis])
+                volume |= padded[tuple(index)]
+    return volume
+
+
+def binary_opening(volume, iterations=1):
+    """
+    Remove foreground specks smaller than the structuring element.
+    """
+    return binary_dilation(binary_erosion(volume, iterations), iterations)
+
+
+def binary_closing(volume, iterations=1):
+    """
+    Fill background holes smaller than the structuring element.
+    """
+    return binary_erosion(binary_dilation(volume, iterations), iterations)
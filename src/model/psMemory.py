@@ -0,0 +1,113 @@
+"""
+Memory accounting for the large arrays of a loaded subject.
+
+Qmaps, DICOM templates, derived volumes (reciprocal maps, lookup indexes, oriented copies, preview levels), the slice
+cache and the synthesized volumes are registered with a MemoryManager. Data that can be recomputed is registered with
+an eviction callback: when the total exceeds the budget ("memory_budget_mb" key of the "synthesis" configuration
+section, 0: no limit) the least recently used recomputable entries are evicted.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class MemoryManager:
+    """
+    Track the memory held by registered entries and evict recomputable ones, least recently used first.
+    budget: bytes, 0 for no limit
+    """
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.evictions = 0
+        # key -> [nbytes, evict callback or None]
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        # over budget with nothing left to evict (warned once)
+        self._over = False
+        # evict callbacks release their entry: re-entrant
+        self._lock = threading.RLock()
+
+    def set_budget(self, budget):
+        with self._lock:
+            self.budget = budget
+            self._enforce()
+
+    def track(self, key, nbytes, evict=None):
+        """
+        Register (or update) an entry of nbytes and mark it as the most recently used.
+        key: hashable identifying the entry, e.g. (owner, name)
+        evict: callable dropping the data, None if the data cannot be recomputed
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[0]
+            self._entries[key] = [nbytes, evict]
+            self._nbytes += nbytes
+            self._enforce(keep=key)
+
+    def touch(self, key):
+        """
+        Mark an entry as used.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._nbytes -= entry[0]
+
+    def nbytes(self):
+        return self._nbytes
+
+    def usage(self):
+        """
+        Return {owner: bytes}, owner being the first element of tuple keys.
+        """
+        with self._lock:
+            usage = dict()
+            for key, (nbytes, _) in self._entries.items():
+                owner = key[0] if isinstance(key, tuple) else key
+                usage[owner] = usage.get(owner, 0) + nbytes
+            return usage
+
+    def report(self):
+        """
+        One line summary of the memory usage.
+        """
+        usage = ", ".join("{} {}".format(owner, format_bytes(nbytes)) for owner, nbytes in self.usage().items())
+        budget = format_bytes(self.budget) if self.budget else "no limit"
+        return "Memory: {} of {} ({})".format(format_bytes(self._nbytes), budget, usage)
+
+    def _enforce(self, keep=None):
+        if not self.budget or self._nbytes <= self.budget:
+            self._over = False
+            return
+        for key in [k for k in self._entries if k != keep and self._entries[k][1] is not None]:
+            if self._nbytes <= self.budget:
+                return
+            nbytes, evict = self._entries[key]
+            log.debug("MemoryManager: evicting {} ({})".format(key, format_bytes(nbytes)))
+            self.release(key)
+            evict()
+            self.evictions += 1
+        if self._nbytes > self.budget and not self._over:
+            self._over = True
+            log.warning("MemoryManager: {} in use, over the {} budget".format(
+                format_bytes(self._nbytes), format_bytes(self.budget)))
+
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB"):
+        if nbytes < 1024:
+            return "{:.0f} {}".format(nbytes, unit)
+        nbytes /= 1024.
+    if nbytes < 1024:
+        return "{:.1f} MB".format(nbytes)
+    return "{:.2f} GB".format(nbytes / 1024.)
@@ -2,14 +2,21 @@ import logging
 import math
 import os
 from enum import Enum
+from functools import partial
 import random
-from PyQt5.QtCore import QObject, pyqtSignal, QPoint
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PyQt5.QtCore import QObject, pyqtSignal, QPoint, QTimer
 from PyQt5.QtWidgets import QApplication
 
 from src.model.psExceptions import NotLoadedMapError, NotSelectedMapError
 from src.model.psFileType import psFileType
 from src.model.validateConfig import ValidateConfig
 from src.model.MRIImage import Qmap, Smap, Orientation
+from src.model.psMemory import MemoryManager
+from src.model.psPrefetch import SlicePrefetcher
+from src.model.psScheduler import RecomputeScheduler, SynthesisRequest
+from src.model.psSynthEngine import create_backend
+from src.model.psVolumeCache import VolumeCache
 from src.view.psSliderParam import PsSliderParam
 
 log = logging.getLogger(__name__)
@@ -58,16 +65,29 @@ class PsModel:
         # self._default_smaps = [t for t in self.config.synth_types]
         # self._default_smaps = [t[0] for t in Config.synth_images]
 
+        # accounting of the large arrays of the loaded subject
+        self._memory = MemoryManager()
+        self._volume_cache = VolumeCache()
         # qmaps
         self._qmaps = dict()
         for qmap in self.config.qmap_types:
-            self._qmaps[qmap] = Qmap(map_type=qmap)
+            self._qmaps[qmap] = Qmap(map_type=qmap, dtype=self.config.synthesis["dtype"])
 
         # orientation
         self._orientation = Orientation.AXIAL  # default
         # synthetic imag`e
         self._smap = Smap(self._qmaps)
         self._smap.set_orientation(self._orientation)
+        # background synthesis of the next slices while scrolling
+        self._prefetcher = SlicePrefetcher(self._smap)
+        # background synthesis of the displayed slice while dragging the parameter sliders
+        self._scheduler = RecomputeScheduler(self._smap)
+        self._scheduler.signal_smap_ready.connect(self.on_scheduled_smap)
+        # full resolution synthesis once the interaction goes idle (previews are shown meanwhile)
+        self._idle_timer = QTimer()
+        self._idle_timer.setSingleShot(True)
+        self._idle_timer.timeout.connect(self.on_interaction_idle)
+        self.configure_synthesis()
         # selected_smap = list(self._default_smaps.keys())[0]
         # self._smap.set_map_type(selected_smap)
         # self._smap.set_title(self._default_smaps[selected_smap]["title"])
@@ -85,6 +105,28 @@ class PsModel:
         self._anchor_point = QPoint(0, 0)
         self._translated_point = QPoint(0, 0)
         self._screenshot_image = None  # cached generated image fort screenshot
+        # inputs of the last synthesized image (see Smap.get_dependency_state)
+        self._computed_state = None
+
+    def configure_synthesis(self):
+        # synthesis engine options from "synthesis" config section
+        synthesis = self.config.synthesis
+        self._smap.set_backend(create_backend(synthesis))
+        self._smap.set_lut_size(synthesis["lut_size"] if synthesis["lut"] else 0)
+        self._smap.get_slice_cache().set_capacity(synthesis["slice_cache_mb"] * 2 ** 20)
+        self._smap.set_scaling_samples(synthesis["scaling_samples"])
+        self._smap.set_chunk_memory(synthesis["chunk_memory_mb"] * 2 ** 20)
+        self._smap.set_mask_options(synthesis["mask_source"], synthesis["mask_threshold"], synthesis["mask_cleanup"])
+        self._memory.set_budget(synthesis["memory_budget_mb"] * 2 ** 20)
+        self._smap.set_memory_manager(self._memory)
+        loading = self.config.loading
+        self._volume_cache.set_directory(loading["volume_cache_dir"])
+        self._volume_cache.set_capacity(loading["volume_cache_mb"] * 2 ** 20)
+        for qmap in self._qmaps.values():
+            qmap.set_oriented_copies(synthesis["oriented_copies"])
+            qmap.set_memory_manager(self._memory)
+            qmap.set_volume_cache(self._volume_cache)
+        self._prefetcher.set_depth(synthesis["prefetch_slices"] if synthesis["slice_cache_mb"] else 0)
 
     def set_h_v_parameter_interaction(self, h_v_parameter_interaction):
         self._h_v_parameter_interaction = h_v_parameter_interaction
@@ -108,40 +150,123 @@ class PsModel:
         return False
 
     def update_qmap_batch_path(self, root_path, file_type):
-        # foreach qmap defined in config.json
+        """
+        Load the qmaps found in root_path, matched by the "file_name" of each qmap defined in config.json, all at
+        once on a pool of threads. Each qmap is shown as soon as it is loaded; the GUI stays responsive meanwhile.
+        """
+        # one scan of the directory for all the qmaps
+        file_names = os.listdir(root_path)
+        paths = dict()
         for qmap_type in self._qmaps:
             file_regex_basename = self.config.qmap_types[qmap_type]["file_name"]
-            for file_complete_basename in os.listdir(root_path):
+            for file_complete_basename in file_names:
                 if file_regex_basename.lower() in file_complete_basename.lower():
-                    path = os.path.join(root_path, file_complete_basename)
-                    self.update_qmap_path(qmap_type, path, file_type)
+                    paths[qmap_type] = os.path.join(root_path, file_complete_basename)
+            # no folder of its own: series of the study folder picked by description
+            if (qmap_type not in paths and file_type == psFileType.DICOM
+                    and self.config.qmap_types[qmap_type]["series_description"]):
+                paths[qmap_type] = root_path
+        if not paths:
+            return
+        # the DICOM reading threads are shared among the qmaps
+        workers = self.config.loading["dicom_workers"] or (os.cpu_count() or 1)
+        workers = max(1, workers // len(paths))
+        # qmap -> percentage of files read, updated by the loading threads
+        progress = dict()
+        # qmaps not loaded, reported at the end
+        failed = []
+
+        def report(qmap_type, done, total):
+            progress[qmap_type] = 100 * done // total
+
+        with ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix="qmap") as executor:
+            futures = dict()
+            for qmap_type, path in paths.items():
+                self.prepare_qmap(qmap_type, path)
+                futures[executor.submit(self.load_qmap, qmap_type, file_type, workers,
+                                        partial(report, qmap_type))] = qmap_type
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    qmap_type = futures[future]
+                    try:
+                        future.result()
+                        self.on_qmap_loaded(qmap_type)
+                    except Exception:
+                        log.exception("{} map cannot be loaded from {}".format(qmap_type, paths[qmap_type]))
+                        failed.append(qmap_type)
+                if pending:
+                    loading = [futures[future] for future in futures if future in pending]
+                    self.c.signal_update_status_bar.emit("Loading {} maps... {}".format(", ".join(loading), " ".join(
+                        "{}: {}%".format(qmap_type, progress[qmap_type]) for qmap_type in loading
+                        if qmap_type in progress)))
+                QApplication.processEvents()
+        if failed:
+            self.c.signal_update_status_bar.emit("{} map{} CANNOT BE loaded. Check again path: {}".format(
+                ", ".join(failed), "s" if len(failed) > 1 else "", ", ".join(paths[qmap_type] for qmap_type in failed)))
 
     def update_qmap_path(self, qmap_type, path, file_type):
+        self.prepare_qmap(qmap_type, path)
+        # a new path is choosen -> reload map
+        try:
+            if not self.load_qmap(qmap_type, file_type, self.config.loading["dicom_workers"],
+                                  partial(self.report_loading, qmap_type)):
+                return
+            self.on_qmap_loaded(qmap_type)
+        except:
+            self.c.signal_update_status_bar.emit(
+                "{} map CANNOT BE loaded. Check again path: {}".format(qmap_type, path))
+
+    def prepare_qmap(self, qmap_type, path):
+        # a qmap is replaced: prefetched and scheduled slices would be stale, and the workers must not read the qmap
+        # while it is reloaded (possibly on another thread)
+        self._prefetcher.cancel()
+        self._scheduler.cancel()
+        self._prefetcher.wait()
+        self._scheduler.wait()
         # crate new map only if exist [TODO singleton]
         if qmap_type not in self._qmaps.keys():
-            self._qmaps[qmap_type] = Qmap(map_type=qmap_type)
+            self._qmaps[qmap_type] = Qmap(map_type=qmap_type, dtype=self.config.synthesis["dtype"])
+            self._qmaps[qmap_type].set_oriented_copies(self.config.synthesis["oriented_copies"])
+            self._qmaps[qmap_type].set_memory_manager(self._memory)
+            self._qmaps[qmap_type].set_volume_cache(self._volume_cache)
         self._qmaps[qmap_type].path = path
         self._qmaps[qmap_type].is_loaded = False
         self._qmaps[qmap_type].set_orientation(self._orientation)
         log.debug(
             "update_qmap_path: {} of qmap: {}".format(self._qmaps[qmap_type].path, self._qmaps[qmap_type].map_type))
-        # a new path is choosen -> reload map
-        try:
-            if file_type == psFileType.DICOM:
-                self._qmaps[qmap_type].load_from_dicom()
-            elif file_type == psFileType.NIFTII:
-                self._qmaps[qmap_type].load_from_niftii()
-            else:
-                return
-            self._qmaps[qmap_type].is_loaded = True
 
-            self.generate_slice_slider()
-            # show map on GUI
-            self.c.signal_qmap_updated.emit(qmap_type)
-            self.c.signal_update_status_bar.emit("{} map correctly loaded".format(qmap_type))
-        except:
-            self.c.signal_update_status_bar.emit(
-                "{} map CANNOT BE loaded. Check again path: {}".format(qmap_type, path))
+    def load_qmap(self, qmap_type, file_type, workers=0, progress=None):
+        """
+        Load the file(s) of a qmap prepared with prepare_qmap. Does not touch the GUI: can run on any thread.
+        Returns False for an unknown file type.
+        """
+        if file_type == psFileType.DICOM:
+            self._qmaps[qmap_type].load_from_dicom(workers=workers, progress=progress,
+                                                   series_description=self.config.qmap_types[qmap_type][
+                                                       "series_description"],
+                                                   index_directory=self.config.loading["dicom_index_dir"])
+        elif file_type == psFileType.NIFTII:
+            self._qmaps[qmap_type].load_from_niftii(lazy=self.config.loading["lazy_niftii"])
+        else:
+            return False
+        return True
+
+    def on_qmap_loaded(self, qmap_type):
+        self._qmaps[qmap_type].is_loaded = True
+
+        self.generate_slice_slider()
+        # show map on GUI
+        self.c.signal_qmap_updated.emit(qmap_type)
+        self.c.signal_update_status_bar.emit("{} map correctly loaded. {}".format(qmap_type, self.report_memory()))
+
+    def report_loading(self, qmap_type, done, total):
+        """
+        Show the loading progress of a qmap, keeping the GUI responsive.
+        """
+        self.c.signal_update_status_bar.emit("Loading {} map: {}%".format(qmap_type, 100 * done // total))
+        QApplication.processEvents()
 
     def update_qmap_colormap(self, qmap_k, colormap):
         log.debug(f"Update colormap to {colormap}")
@@ -198,7 +323,16 @@ class PsModel:
             self._smap.save_dicom(path)
 
         self.c.signal_update_status_bar.emit(
-            "{} map saved on {} in {} format.".format(self.get_smap().file_type, path, file_type))
+            "{} map saved on {} in {} format. {}".format(self.get_smap().file_type, path, file_type,
+                                                         self.report_memory()))
+
+    def report_memory(self):
+        """
+        Log the memory usage of the loaded data and return it as a one line summary.
+        """
+        report = self._memory.report()
+        log.info(report)
+        return report
 
     def set_header_tag(self, tag, value):
         self._smap.set_header_tag(tag, value)
@@ -213,6 +347,7 @@ class PsModel:
         return self.config.presets
 
     def set_orientation(self, orientation):
+        self._prefetcher.cancel()
         # set all orientation
         self._orientation = orientation
         self._smap.set_orientation(orientation)
@@ -297,21 +432,118 @@ class PsModel:
         # log.debug("reload_smap #{}".format(counter_reload))
         self.c.signal_smap_updated.emit(self._smap.get_map_type())
 
-    def recompute_smap(self):
+    def recompute_smap(self, force=False):
+        """
+        Synthesize the displayed slice, unless none of its inputs changed since the last synthesis.
+        Return True if the image was recomputed.
+        """
+        # slices prefetched for the previous inputs would compete with this synthesis
+        self._prefetcher.cancel()
+        state = self._smap.get_dependency_state()
+        if not force and state is not None and state == self._computed_state and self._smap.is_loaded():
+            log.debug("recompute_smap: inputs unchanged, skipped")
+            return False
+        # a background synthesis would overwrite this image with an older state
+        self._scheduler.cancel()
         # PROFILELP
         # pr.enable()
         self._smap.recompute_smap()
         # pr.disable()
         # PROFILEPL
+        self._computed_state = state
+        log.debug("recompute_smap: slice cache {}".format(self._smap.get_slice_cache().stats()))
+        return True
 
         # self.c.signal_smap_updated.emit(self._smap.get_map_type())
 
+    def schedule_recompute_smap(self, preview=False):
+        """
+        Synthesize the displayed slice in background (see RecomputeScheduler): the smap is reloaded when the image is
+        ready. Requests arriving while busy replace each other, only the newest one is computed.
+        preview: the user is interacting, synthesize a low resolution preview (if enabled and the slice is not cached)
+                 and the full resolution image once the interaction is idle
+        """
+        # parameters changed: prefetched slices would be stale
+        self._prefetcher.cancel()
+        state = self._smap.get_dependency_state()
+        if state is not None and state == self._computed_state and self._smap.is_loaded():
+            # back to the displayed inputs (e.g. A -> B -> A drag): the request in flight is stale
+            self._scheduler.cancel()
+            return
+        self._smap.check_synthesis_inputs()
+        factor = self.config.synthesis["preview_factor"] if preview else 1
+        if factor > 1 and self._smap.get_slice_cache().contains(self._smap.get_cache_key()):
+            factor = 1
+        self._scheduler.request(
+            SynthesisRequest(state, self._smap.get_position(), self._smap.get_synthesis_state(), factor))
+        if factor > 1:
+            self._idle_timer.start(self.config.synthesis["preview_idle_ms"])
+
+    def on_interaction_idle(self):
+        try:
+            self.schedule_recompute_smap()
+        except (NotLoadedMapError, NotSelectedMapError) as e:
+            log.debug("on_interaction_idle: {}".format(e.message))
+
+    def on_scheduled_smap(self, request, img):
+        # the smap type, equation, parameter values or displayed slice changed meanwhile: the image is not valid
+        # anymore
+        current = self._smap.get_dependency_state()
+        if current is None or current != request.dependency_state or request.state[0] != self._smap.get_map_type():
+            return
+        self._smap.np_matrix = img
+        # a preview is replaced by the full resolution image when the interaction is idle
+        self._computed_state = request.dependency_state if request.factor <= 1 else None
+        log.debug("on_scheduled_smap: {}".format(self._scheduler.stats()))
+        self.reload_smap()
+
+    def shutdown(self):
+        self._idle_timer.stop()
+        self._scheduler.stop()
+        self._prefetcher.shutdown()
+        self._smap.get_backend().shutdown()
+
+    def get_synthesis_states(self, smaps):
+        """
+        Synthesis states (see Smap.get_synthesis_state) of the smaps whose qmaps are loaded.
+        """
+        return [self._smap.get_synthesis_state(smap_k, self._default_smaps[smap_k]["equation"],
+                                               self._default_smaps[smap_k]["parameters"])
+                for smap_k in smaps if not self.has_missing_qmap(smap_k)]
+
+    def prefetch_contrasts(self):
+        """
+        Synthesize in background the displayed slice for the other contrasts of the current preset, in one pass.
+        """
+        if not self._prefetcher.depth:
+            return
+        smaps = [smap_k for smap_k in self._default_smaps
+                 if self._default_smaps[smap_k]["preset"] == self._current_preset and
+                 smap_k != self._smap.get_map_type()]
+        self._prefetcher.request_contrasts(self.get_synthesis_states(smaps))
+
+    def prefetch_slices(self, direction):
+        """
+        Synthesize in background the next slices in the scroll direction (+1 forward, -1 backward).
+        """
+        if self._smap.get_missing_qmaps() or not self._smap.get_map_type():
+            return
+        self._prefetcher.request(direction)
+
+    def sweep_smap(self, param_matrix, dims=2, roi=None):
+        """
+        Synthesize the current smap for each row of param_matrix (see Smap.sweep).
+        """
+        return self._smap.sweep(param_matrix, dims, roi,
+                                memory_budget=self.config.synthesis["chunk_memory_mb"] * 2 ** 20)
+
     def set_smap_type(self, smap_type):
         log.debug(__name__)
         # import gc
         # print(len(gc.get_objects()))
         # gc.collect()
         # print(len(gc.get_objects()))
+        self._prefetcher.cancel()
         self._smap.set_map_type(smap_type)
         self._smap.set_title(self._default_smaps[smap_type]["title"])
         self._smap.set_init_slices_num(self._qmaps[list(self._qmaps.keys())[0]])
@@ -337,6 +569,7 @@ class PsModel:
         except NotLoadedMapError as e:
             self.c.signal_update_status_bar.emit(e.message)
             return
+        self.prefetch_contrasts()
 
         self.c.signal_parameters_updated.emit()
         self.c.signal_parameter_sliders_init_handlers.emit()
@@ -426,6 +659,7 @@ class PsModel:
 
     def reload_configuration_file(self):
         self.config = ValidateConfig()
+        self.configure_synthesis()
         for smap_k in self.config.synth_types:
             smap_new_conf = self.config.synth_types[smap_k]
             if smap_k in self._default_smaps:
@@ -555,7 +789,7 @@ class PsModel:
                                          sp["value"],
                                          sp["step"],
                                          sp["mouse"])
-        self.config.validate_equation(new_smap)
+        self.config.validate_equation(new_smap, new_smap["name"])
         self._default_smaps[new_smap["name"]] = new_smap
         # self.c.signal_custom_smap_added.emit(new_smap["name"])
         self.set_smap_type(new_smap["name"])
@@ -632,6 +866,8 @@ class PsModel:
             # 2 compute all smaps
             # get only preset
             smaps = {k: v for k, v in self._default_smaps.items() if k in smaps}
+            # the volumes fitting in the memory budget in one pass over the qmaps, sharing common sub-terms
+            self._smap.prepare_volumes(self.get_synthesis_states(smaps))
 
             for smap_k in smaps:
                 self.c.signal_update_status_bar.emit(
@@ -662,6 +898,8 @@ class PsModel:
 
                     self.save_smap(os.path.join(smaps_path, smap_k[:-len(" - " + self._current_preset)]),
                                    psFileType.DICOM)  # TODO ERROR _current_preset!
+            # volumes of the smaps not exported (e.g. on errors) are not kept for the next subject
+            self._smap.release_volumes()
 
     def search_forlder(self, root_path, folder_name):
         for root, dirs, files in os.walk(root_path):
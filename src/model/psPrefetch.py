@@ -0,0 +1,103 @@
+"""
+Background synthesis of the slices the user is about to display.
+
+While scrolling (mouse wheel or SLICE mouse behaviour) the next slices in the scroll direction are synthesized in a
+worker thread and stored in the slice cache, so the GUI thread finds them ready. The number of slices synthesized ahead
+is the "prefetch_slices" key of the "synthesis" configuration section (0 disables prefetching).
+The same worker synthesizes the displayed slice for the other contrasts of the preset, so that switching contrast from
+the toolbar finds the image ready.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class SlicePrefetcher:
+    """
+    Synthesize in a worker thread the slices following the displayed one in the scroll direction.
+    Each request supersedes the previous one: pending slices of a stale request (other direction, slice, parameters
+    or smap) are dropped.
+    smap: Smap whose slice cache is filled
+    depth: number of slices synthesized ahead
+    """
+
+    def __init__(self, smap, depth=0):
+        self._smap = smap
+        self.depth = depth
+        self.prefetched = 0
+        self.cancelled = 0
+        self._token = 0
+        self._executor = None
+
+    def set_depth(self, depth):
+        self.depth = depth
+        self.cancel()
+
+    def cancel(self):
+        """
+        Drop the pending work.
+        """
+        self._token += 1
+
+    def request(self, direction):
+        """
+        Prefetch the slices after the displayed one.
+        direction: +1 scrolling forward, -1 scrolling backward
+        """
+        self.cancel()
+        if not self.depth or not direction:
+            return
+        # snapshot taken in the GUI thread: the worker never reads the mutable smap state
+        state = self._smap.get_synthesis_state()
+        positions = self._smap.get_next_positions(direction, self.depth)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._executor.submit(self._run, self._token, positions, state)
+
+    def request_contrasts(self, states):
+        """
+        Synthesize the displayed slice for several smaps in one pass (see Smap.synthesize_contrasts).
+        states: synthesis states of the smaps (see Smap.get_synthesis_state)
+        """
+        self.cancel()
+        if not states:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._executor.submit(self._run_contrasts, self._token, self._smap.get_position(), states)
+
+    def wait(self):
+        """
+        Block until the work in progress, if any, is over (after cancel, the remaining slices are dropped).
+        """
+        if self._executor is not None:
+            self._executor.submit(lambda: None).result()
+
+    def shutdown(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _run(self, token, positions, state):
+        for i, position in enumerate(positions):
+            if token != self._token:
+                self.cancelled += len(positions) - i
+                log.debug("SlicePrefetcher: stale request, {} slices dropped".format(len(positions) - i))
+                return
+            try:
+                self._smap.synthesize_slice(position, state)
+            except Exception as e:
+                log.warning("SlicePrefetcher: slice {} not synthesized: {}".format(position, e))
+                return
+            self.prefetched += 1
+
+    def _run_contrasts(self, token, position, states):
+        if token != self._token:
+            self.cancelled += len(states)
+            return
+        try:
+            self._smap.synthesize_contrasts(states, position)
+        except Exception as e:
+            log.warning("SlicePrefetcher: contrasts not synthesized: {}".format(e))
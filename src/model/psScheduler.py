@@ -0,0 +1,146 @@
+"""
+Latest-wins scheduling of the interactive synthesis.
+
+Dragging a parameter slider emits a value for every step. RecomputeScheduler synthesizes the displayed slice in a worker
+QThread: while a synthesis is running, each new request replaces the pending one, so only the newest parameter state is
+computed next and the intermediate ones are dropped. Finished images are posted back to the GUI thread with
+signal_smap_ready.
+"""
+import logging
+import threading
+from collections import namedtuple
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
+
+from src.model.psEquation import TermCache
+
+log = logging.getLogger(__name__)
+
+# dependency_state: Smap.get_dependency_state, position: Smap.get_position, state: Smap.get_synthesis_state,
+# factor: > 1 for a low resolution preview (see Smap.synthesize_preview)
+SynthesisRequest = namedtuple("SynthesisRequest", ["dependency_state", "position", "state", "factor"],
+                              defaults=(1,))
+
+
+class SynthesisWorker(QObject):
+    """
+    Synthesize the requested slices. Lives in the scheduler thread.
+    """
+    signal_computed = pyqtSignal(object, object)  # request, image
+    signal_failed = pyqtSignal(object, str)  # request, message
+
+    def __init__(self, smap, is_current):
+        super(SynthesisWorker, self).__init__()
+        self._smap = smap
+        # is_current(serial): False if the request was cancelled before it started
+        self._is_current = is_current
+        # held while synthesizing (see RecomputeScheduler.wait)
+        self.lock = threading.Lock()
+        # sub-terms of the last slice synthesized by the worker (only used in the worker thread)
+        self._term_cache = TermCache()
+
+    @pyqtSlot(int, object)
+    def compute(self, serial, request):
+        with self.lock:
+            if not self._is_current(serial):
+                self.signal_failed.emit(request, "cancelled")
+                return
+            try:
+                if request.factor > 1:
+                    img = self._smap.synthesize_preview(request.factor, request.position, request.state)
+                else:
+                    img = self._smap.synthesize_slice(request.position, request.state, term_cache=self._term_cache)
+            except Exception as e:
+                log.warning("SynthesisWorker: {}".format(e))
+                self.signal_failed.emit(request, str(e))
+                return
+        self.signal_computed.emit(request, img)
+
+
+class RecomputeScheduler(QObject):
+    """
+    Run one synthesis at a time in a worker thread, keeping only the newest request while busy.
+    computed: number of synthesized requests
+    dropped: number of requests replaced by a newer one (or cancelled) before being shown
+    """
+    signal_request = pyqtSignal(int, object)  # serial, request, to the worker
+    signal_smap_ready = pyqtSignal(object, object)  # request, image
+
+    def __init__(self, smap):
+        super(RecomputeScheduler, self).__init__()
+        self.computed = 0
+        self.dropped = 0
+        self._pending = None
+        self._busy = False
+        # incremented by cancel: results of older requests are discarded
+        self._serial = 0
+        # serial of the running request
+        self._running = 0
+
+        self._thread = QThread()
+        self._worker = SynthesisWorker(smap, lambda serial: serial == self._serial)
+        self._worker.moveToThread(self._thread)
+        self.signal_request.connect(self._worker.compute)
+        self._worker.signal_computed.connect(self._on_computed)
+        self._worker.signal_failed.connect(self._on_failed)
+        self._thread.start()
+
+    def request(self, request):
+        """
+        Synthesize request (SynthesisRequest) as soon as the worker is free.
+        """
+        if self._busy:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (self._serial, request)
+            return
+        self._busy = True
+        self._running = self._serial
+        self.signal_request.emit(self._running, request)
+
+    def cancel(self):
+        """
+        Drop the pending request and discard the result of the running one.
+        """
+        if self._pending is not None:
+            self.dropped += 1
+            self._pending = None
+        self._serial += 1
+
+    def wait(self):
+        """
+        Block until the running synthesis, if any, is over: after cancel, the worker does not read the smap or the
+        qmaps anymore (a cancelled request not started yet is skipped).
+        """
+        with self._worker.lock:
+            pass
+
+    def stats(self):
+        return {"computed": self.computed, "dropped": self.dropped, "busy": self._busy}
+
+    def stop(self):
+        self._pending = None
+        self._thread.quit()
+        self._thread.wait()
+
+    @pyqtSlot(object, object)
+    def _on_computed(self, request, img):
+        self.computed += 1
+        stale = self._running != self._serial
+        self._next()
+        if stale:
+            self.dropped += 1
+            return
+        self.signal_smap_ready.emit(request, img)
+
+    @pyqtSlot(object, str)
+    def _on_failed(self, request, message):
+        self._next()
+
+    def _next(self):
+        pending, self._pending = self._pending, None
+        if pending is None:
+            self._busy = False
+            return
+        self._running = pending[0]
+        self.signal_request.emit(pending[0], pending[1])
@@ -0,0 +1,83 @@
+"""
+Cache of synthesized slices.
+
+Scrolling back and forth through a volume, or returning to a previous parameter setting, asks for slices that were
+already synthesized. SliceCache keeps the most recently used ones within a memory budget ("slice_cache_mb" key of the
+"synthesis" configuration section, 0 disables the cache).
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class SliceCache:
+    """
+    Least recently used cache of 2D images.
+    key: any hashable, e.g. (smap type, equation, parameter values, orientation, slice number, qmap generations)
+    capacity: memory budget in bytes
+    Thread safe: slices may be stored by a background worker.
+    """
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_capacity(self, capacity):
+        with self._lock:
+            self.capacity = capacity
+            self._evict()
+
+    def get(self, key):
+        """
+        Return the image stored under key, None if missing.
+        """
+        with self._lock:
+            try:
+                image = self._images[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._images
+
+    def put(self, key, image):
+        if image.nbytes > self.capacity:
+            return
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            self._images[key] = image
+            self._nbytes += image.nbytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._nbytes = 0
+
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._images)
+
+    def stats(self):
+        return {"slices": len(self._images), "bytes": self._nbytes, "capacity": self.capacity,
+                "hits": self.hits, "misses": self.misses}
+
+    def _evict(self):
+        while self._images and self._nbytes > self.capacity:
+            _, image = self._images.popitem(last=False)
+            self._nbytes -= image.nbytes
@@ -0,0 +1,209 @@
+"""
+On-disk cache of the loaded qmap volumes.
+
+Parsing a DICOM series or decompressing a .nii.gz file takes most of the time needed to open a subject. Once loaded,
+a qmap volume is saved in the cache directory ("volume_cache_dir" key of the "loading" configuration section) as a
+raw .npy file, already converted to the synthesis dtype and oriented as the application expects, with a .json file
+describing it. When the same source is opened again, the volume is memory mapped from the cache: reopening a subject
+costs about as much as reading its raw voxels.
+
+Entries are keyed by the source path, the size, modification time and first bytes of each of its files (see
+fingerprint), the dtype and the FORMAT version of the conversion. A changed source gets a new key: its stale entry is
+never read again and ages out. The total size is kept below "volume_cache_mb" (0: cache disabled) by removing the
+least recently used entries.
+
+The cache can be listed and pruned from the command line:
+    python -m src.model.psVolumeCache [--dir DIR] [--max-mb MB | --clear]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# conversion format: increase when the orientation or conversion of loaded volumes changes
+FORMAT = 1
+# bytes of each source file hashed in the fingerprint
+HASH_BYTES = 4096
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser("~"), ".pySynthMRI", "volume_cache")
+
+
+def fingerprint(path, files=None):
+    """
+    Describe the content of a source (file or directory of files): relative path, size, modification time and hash of
+    the first HASH_BYTES of each file.
+    files: files of the source, default all the files below path
+    """
+    if files is not None:
+        files = sorted(str(fname) for fname in files)
+    elif os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        files = [path]
+    description = []
+    for fname in files:
+        stat = os.stat(fname)
+        with open(fname, "rb") as fd:
+            digest = hashlib.blake2b(fd.read(HASH_BYTES), digest_size=16).hexdigest()
+        description.append([os.path.relpath(fname, path) if fname != path else "", stat.st_size, stat.st_mtime_ns,
+                            digest])
+    return description
+
+
+class VolumeCache:
+    """
+    Directory of cached volumes.
+    directory: cache directory, created on first write
+    capacity: bytes, 0 to disable the cache
+    """
+
+    def __init__(self, directory="", capacity=0):
+        self.directory = directory or default_directory()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+    def set_directory(self, directory):
+        self.directory = directory or default_directory()
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        if self.enabled():
+            self.prune(capacity)
+
+    def enabled(self):
+        return self.capacity > 0
+
+    def get_key(self, path, dtype, files=None):
+        """
+        Key of the volume loaded from path (made of files, default all the files below path) in dtype, None if the
+        source cannot be read.
+        """
+        try:
+            description = [FORMAT, os.path.abspath(str(path)), np.dtype(dtype).str, fingerprint(str(path), files)]
+        except OSError:
+            return None
+        return hashlib.blake2b(json.dumps(description).encode(), digest_size=20).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".npy", base + ".json"
+
+    def get(self, key):
+        """
+        Return (volume memory mapped read-only, metadata dictionary) cached under key, or None.
+        """
+        if key is None or not self.enabled():
+            return None
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as fd:
+                meta = json.load(fd)
+            volume = np.load(data_path, mmap_mode="r")
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        # the metadata access time orders the entries for eviction
+        os.utime(meta_path)
+        self.hits += 1
+        log.debug("VolumeCache: hit {} ({})".format(key, meta.get("source")))
+        return volume, meta
+
+    def put(self, key, volume, meta):
+        """
+        Save volume with its metadata (JSON serializable dictionary) under key, then evict the least recently used
+        entries over capacity. Failures are logged, not raised: the cache is an optimization.
+        """
+        if key is None or not self.enabled() or volume.nbytes > self.capacity:
+            return
+        data_path, meta_path = self._paths(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write under temporary names: a concurrent reader never sees a partial entry
+            np.save(data_path + ".tmp.npy", np.ascontiguousarray(volume))
+            os.replace(data_path + ".tmp.npy", data_path)
+            with open(meta_path + ".tmp", "w") as fd:
+                json.dump(meta, fd)
+            os.replace(meta_path + ".tmp", meta_path)
+        except OSError as e:
+            log.warning("VolumeCache: cannot save {}: {}".format(meta.get("source"), e))
+            return
+        log.debug("VolumeCache: saved {} ({})".format(key, meta.get("source")))
+        self.prune(self.capacity)
+
+    def entries(self):
+        """
+        List (key, bytes, last access time, metadata) of the entries, least recently used first.
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            data_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path) as fd:
+                    meta = json.load(fd)
+                entries.append((key, os.path.getsize(data_path), os.path.getmtime(meta_path), meta))
+            except (OSError, ValueError):
+                continue
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def nbytes(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def remove(self, key):
+        for fname in self._paths(key):
+            try:
+                os.remove(fname)
+            except OSError:
+                # missing, or still memory mapped on some systems: removed by a later prune
+                pass
+
+    def prune(self, capacity):
+        """
+        Remove the least recently used entries until the cache holds at most capacity bytes. Returns the number of
+        removed entries.
+        """
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for key, nbytes, _, meta in entries:
+            if total <= capacity:
+                break
+            self.remove(key)
+            total -= nbytes
+            removed += 1
+            log.debug("VolumeCache: evicted {} ({})".format(key, meta.get("source")))
+        return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List and prune the pySynthMRI volume cache.")
+    parser.add_argument("--dir", default="", help="cache directory (default {})".format(default_directory()))
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--max-mb", type=float, help="remove the least recently used entries above this size")
+    group.add_argument("--clear", action="store_true", help="remove all the entries")
+    args = parser.parse_args(argv)
+
+    cache = VolumeCache(args.dir)
+    if args.clear or args.max_mb is not None:
+        removed = cache.prune(0 if args.clear else int(args.max_mb * 2 ** 20))
+        print("{} entries removed".format(removed))
+    entries = cache.entries()
+    for key, nbytes, _, meta in entries:
+        print("{}  {:>10.1f} MB  {} {}".format(key, nbytes / 2 ** 20, meta.get("map_type", ""), meta.get("source", "")))
+    print("{}: {} entries, {:.1f} MB".format(cache.directory, len(entries), sum(e[1] for e in entries) / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -126,3 +126,12 @@ def get_unique_filename(filename_path):
         new_filename_path = filename_path[:-4] + "_" + str(postfix) + ".png"
         postfix += 1
     return new_filename_path
+
+
+def safe_reciprocal(np_matrix):
+    """
+    Compute 1/np_matrix without floating point warnings. Zero voxels give inf, as in a plain division: e.g.
+    exp(-TE*(1/T2)) is 0 where T2 is 0, as exp(-TE/T2).
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.true_divide(1., np_matrix)
@@ -2,6 +2,7 @@ import copy
 import json
 
 from src.model.MRIImage import Interpolation
+from src.model.psEquation import EquationCompiler
 from src.model.psExceptions import ConfigurationFilePermissionError
 
 CONFIG_FILE_NAME = "config.json"
@@ -15,13 +16,22 @@ class ValidateConfig:
 
         self.synth_types = self._parse_synthetic_maps(config)
         self.qmap_types = config["quantitative_maps"]
+        for qmap_type in self.qmap_types:
+            # DICOM series of the qmap in a multi-series folder (see psDicomIndex)
+            self.qmap_types[qmap_type].setdefault("series_description", "")
         self.image_interpolation = config["image_interpolation"]
+        self.synthesis = config.get("synthesis", dict())
+        self.loading = config.get("loading", dict())
         for synth_type in self.synth_types:
             self.validate_equation(self.synth_types[synth_type], synth_type)
             self.validate_scanner_parameters(self.synth_types[synth_type])
             self.validate_window_scale(self.synth_types[synth_type])
         # interpolation
         self.validate_interpolation(self.image_interpolation)
+        # synthesis engine
+        self.validate_synthesis(self.synthesis)
+        # qmap loading
+        self.validate_loading(self.loading)
 
     def _parse_synthetic_maps(self, config):
         # check all available presets
@@ -46,6 +56,42 @@ class ValidateConfig:
         else:
             image_interpolation["interpolation_type"] = Interpolation.NONE
 
+    def validate_synthesis(self, synthesis):
+        # optional section: default to plain numpy evaluation
+        synthesis.setdefault("backend", "numpy")
+        synthesis.setdefault("threads", 0)
+        synthesis.setdefault("block_size", 2 ** 16)
+        synthesis.setdefault("dtype", "float64")
+        if synthesis["dtype"] not in ("float32", "float64"):
+            raise TypeError("Synthesis dtype must be float32 or float64.")
+        synthesis.setdefault("chunk_memory_mb", 256)
+        synthesis.setdefault("slice_cache_mb", 128)
+        synthesis.setdefault("prefetch_slices", 4)
+        synthesis.setdefault("scaling_samples", 65536)
+        synthesis.setdefault("mask_source", "")
+        synthesis.setdefault("mask_threshold", 0.01)
+        synthesis.setdefault("mask_cleanup", 0)
+        synthesis.setdefault("oriented_copies", False)
+        synthesis.setdefault("preview_factor", 2)
+        synthesis.setdefault("preview_idle_ms", 150)
+        synthesis.setdefault("memory_budget_mb", 0)
+        if synthesis["preview_factor"] not in (0, 1, 2, 4):
+            raise TypeError("Synthesis preview_factor must be 0 or 1 (disabled), 2 or 4.")
+        synthesis.setdefault("lut", False)
+        synthesis.setdefault("lut_size", 4096)
+        if not 2 < synthesis["lut_size"] <= 2 ** 16:
+            raise TypeError("Synthesis lut_size must be between 3 and 65536.")
+
+    def validate_loading(self, loading):
+        # optional section
+        loading.setdefault("dicom_workers", 0)
+        loading.setdefault("lazy_niftii", False)
+        loading.setdefault("volume_cache_dir", "")
+        loading.setdefault("volume_cache_mb", 0)
+        loading.setdefault("dicom_index_dir", "")
+        if not isinstance(loading["dicom_workers"], int) or loading["dicom_workers"] < 0:
+            raise TypeError("Loading dicom_workers must be a non negative integer.")
+
     def validate_scanner_parameters(self, synth_type):
         synth_type["mouse_v"] = None
         synth_type["mouse_h"] = None
@@ -63,33 +109,13 @@ class ValidateConfig:
 
 
     def validate_equation(self, synth_type, synth_type_label):
-        symbols = ["exp", "abs", "sqrt", "cos", "sin", "tan"]
+        # keep original equation for visualization, compile it once for synthesis
         synth_type["equation_string"] = synth_type["equation"]
-
-        # check parenthesis
-        if synth_type["equation"].count("(") != synth_type["equation"].count(")"):
-            raise TypeError("Check parenthesis in {} equation.".format(synth_type_label))
-
-        for s in symbols:
-            symbol = s + "("
-            synth_type["equation"] = synth_type["equation"].replace(symbol, "np." + symbol)
-
-        synth_type["equation"] = synth_type["equation"].replace("Pi", "np.pi")
-        # synth_type["equation"] = synth_type["equation"].replace("exp(", "np.exp(")
-        # synth_type["equation"] = synth_type["equation"].replace("abs(", "np.abs(")
-        for scanner_param in synth_type["parameters"]:
-            synth_type['title']  # (?<=\b|[a-zA-Z0-9])TI(?=\b|_)
-            # '(?<![a-zA-Z])'+ scanner_param + '(?![a-z-Z])'
-            synth_type["equation"] = synth_type["equation"].replace(scanner_param,
-                                                                    'self._parameters["' + scanner_param + '"]["value"]')
-        synth_type["qmaps_needed"] = []
-        for qmap in self.qmap_types:
-            if qmap in synth_type["equation"]:
-                synth_type["qmaps_needed"].append(qmap)
-
-        for qmap in self.qmap_types:
-            synth_type["equation"] = synth_type["equation"].replace(qmap,
-                                                                    'self._qmaps["' + qmap + '"].get_matrix(dim=dims)')
+        compiler = EquationCompiler(self.qmap_types)
+        synth_type["equation"] = compiler.compile(synth_type["equation_string"],
+                                                  synth_type["parameters"].keys(),
+                                                  synth_type_label)
+        synth_type["qmaps_needed"] = list(synth_type["equation"].qmaps)
 
     def validate_window_scale(self, synth_struct):
         if "window_center" not in synth_struct:
@@ -48,6 +48,7 @@ if __name__ == '__main__':
     app.setPalette(palette)
 
     model = PsModel()
+    app.aboutToQuit.connect(model.shutdown)
 
     view = PsMainWindow(model)
     general_controller = PsController(model, view)
@@ -121,9 +121,8 @@ class PsQMapWidget(QWidget):
             return
 
         if self.qmap.get_inverted():
-            np_matrix_2d = 1. / np_matrix_2d
+            np_matrix_2d = self.qmap.get_reciprocal_matrix(dim=2) * 10000
             np_matrix_2d[np_matrix_2d == np.inf] = 0
-            np_matrix_2d = np_matrix_2d * 10000
 
         img_2d_cp = np_matrix_2d.astype(np.uint16)
 
@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from src.model.MRIImage import Orientation, Qmap, Smap
+from src.model.psEquation import EquationCompiler
+from src.model.psVolumeCache import VolumeCache
+
+
+def write_series(path, shape=(6, 12, 20), locations=("SliceLocation", "ImagePositionPatient"), description="T1 map",
+                 seed=0):
+    """
+    Write a (slices, rows, columns) uint16 series, files in shuffled slice order. Returns the stored values.
+    locations: attributes giving the slice locations
+    """
+    os.makedirs(path)
+    rng = np.random.default_rng(seed)
+    stored = rng.integers(1000, 4000, size=shape).astype(np.uint16)
+    series_uid = generate_uid()
+    for n, i in enumerate(rng.permutation(shape[0])):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesDescription = description
+        ds.Modality = "MR"
+        ds.PatientName = "TEST"
+        ds.PatientID = "0"
+        ds.StudyID = "0"
+        ds.PatientBirthDate = ""
+        ds.StudyDescription = ""
+        ds.StudyDate = ""
+        ds.Rows, ds.Columns = shape[1:]
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.PixelSpacing = [1., 1.]
+        if "SliceLocation" in locations:
+            ds.SliceLocation = 2. * i
+        if "ImagePositionPatient" in locations:
+            ds.ImagePositionPatient = [0., 0., 2. * i]
+        ds.PixelData = stored[i].tobytes()
+        ds.save_as(os.path.join(path, "IM{:04d}".format(n)), enforce_file_format=True)
+    return stored
+
+
+def load_qmap(path, tmp_path, volume_cache=None):
+    qmap = Qmap("T1")
+    qmap.path = str(path)
+    qmap.set_volume_cache(volume_cache)
+    qmap.load_from_dicom(index_directory=str(tmp_path / "index"))
+    qmap.is_loaded = True
+    qmap.set_orientation(Orientation.AXIAL)
+    return qmap
+
+
+def export(qmap, path):
+    smap = Smap({"T1": qmap})
+    smap.set_orientation(Orientation.AXIAL)
+    smap.set_init_slices_num(qmap)
+    smap.set_map_type("T1W")
+    smap.set_qmaps_needed(["T1"])
+    smap.set_scanner_parameters(dict())
+    smap.set_equation(EquationCompiler(["T1"]).compile("T1", []))
+    smap.set_window_center(3000)
+    smap.set_window_width(6000)
+    smap.set_series_number(100)
+    smap.set_header_tag("PatientID", "000")
+    smap.set_header_tag("StudyID", "1")
+    smap.save_dicom(str(path))
+    return smap
+
+
+def check_export(smap, stored, path):
+    exported = sorted((pydicom.dcmread(os.path.join(path, f)) for f in os.listdir(path)),
+                      key=lambda ds: ds.InstanceNumber)
+    assert len(exported) == stored.shape[0]
+    # exported slices as stored in the source files
+    expected = smap.scale(stored.astype(np.float64)).astype(np.short)
+    for ds, image in zip(exported, expected):
+        assert (ds.Rows, ds.Columns) == stored.shape[1:]
+        np.testing.assert_allclose(ds.pixel_array, image, atol=1)
+
+
+def test_export_non_square_dicom(tmp_path):
+    stored = write_series(tmp_path / "T1")
+    smap = export(load_qmap(tmp_path / "T1", tmp_path), tmp_path / "out")
+    check_export(smap, stored, tmp_path / "out")
+
+
+def test_export_cached_dicom(tmp_path):
+    stored = write_series(tmp_path / "T1")
+    cache = VolumeCache(str(tmp_path / "cache"), 2 ** 30)
+    load_qmap(tmp_path / "T1", tmp_path, cache)
+    # reopened from the cache: the templates are read back from the source files
+    qmap = load_qmap(tmp_path / "T1", tmp_path, cache)
+    assert cache.hits == 1 and qmap.original_template is None
+    smap = export(qmap, tmp_path / "out")
+    check_export(smap, stored, tmp_path / "out")
+
+
+def test_load_without_slice_location(tmp_path):
+    stored = write_series(tmp_path / "T1", locations=("ImagePositionPatient",))
+    qmap = load_qmap(tmp_path / "T1", tmp_path)
+    np.testing.assert_array_equal(qmap.np_matrix, stored[:, ::-1, ::-1].transpose(2, 1, 0))
+
+
+def test_load_without_location(tmp_path):
+    write_series(tmp_path / "T1", locations=())
+    with pytest.raises(ValueError, match="neither SliceLocation nor ImagePositionPatient"):
+        load_qmap(tmp_path / "T1", tmp_path)
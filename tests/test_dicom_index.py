@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.model.MRIImage import Qmap
+from src.model.psDicomIndex import DicomIndex, read_entry
+from test_dicom_export import write_series
+
+
+@pytest.fixture
+def study(tmp_path):
+    """
+    Study folder with a T1 and a T2 map series, and a file that is not DICOM.
+    """
+    root = tmp_path / "study"
+    stored = {"T1": write_series(root / "t1", description="T1 map", seed=1),
+              "T2": write_series(root / "t2", description="T2 map", seed=2)}
+    (root / "README.txt").write_text("not DICOM")
+    return root, stored
+
+
+def test_series_of_a_study(tmp_path, study):
+    root, _ = study
+    index = DicomIndex(root, str(tmp_path / "index"))
+    assert index.update() == 13
+    series = index.series()
+    assert [s.description for s in series] == ["T1 map", "T2 map"]
+    for s in series:
+        assert len(s.files) == 6
+        # files in slice order
+        assert [read_entry(f)[3] for f in s.files] == [2. * i for i in range(6)]
+        assert all(os.path.dirname(f) == str(root / s.description[:2].lower()) for f in s.files)
+    assert [s.description for s in index.find("*T2*")] == ["T2 map"]
+    assert index.select("*t1*map").description == "T1 map"
+
+
+def test_ambiguous_selection(tmp_path, study):
+    root, _ = study
+    index = DicomIndex(root, str(tmp_path / "index"))
+    index.update()
+    with pytest.raises(ValueError, match="2 DICOM series matching \\*map\\*"):
+        index.select("*map*")
+    with pytest.raises(ValueError, match="2 DICOM series in"):
+        index.select()
+    with pytest.raises(ValueError, match="No DICOM series matching \\*PD\\*"):
+        index.select("*PD*")
+
+
+def test_stale_entries(tmp_path, study):
+    root, _ = study
+    directory = str(tmp_path / "index")
+    DicomIndex(root, directory).update()
+    # saved: nothing read again
+    index = DicomIndex(root, directory)
+    assert index.update() == 0
+    assert len(index.find("T1 map")[0].files) == 6
+
+    # modified file read again, removed file dropped
+    t1_files = index.find("T1 map")[0].files
+    stat = os.stat(t1_files[0])
+    os.utime(t1_files[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.remove(t1_files[1])
+    assert index.update() == 1
+    assert len(index.find("T1 map")[0].files) == 5
+    assert DicomIndex(root, directory).update() == 0
+
+
+def test_load_series_by_description(tmp_path, study):
+    root, stored = study
+    qmap = Qmap("T2")
+    qmap.path = str(root)
+    qmap.load_from_dicom(series_description="*t2*", index_directory=str(tmp_path / "index"))
+    np.testing.assert_array_equal(qmap.np_matrix, stored["T2"][:, ::-1, ::-1].transpose(2, 1, 0))
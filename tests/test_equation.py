@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from src.model.MRIImage import Qmap
+from src.model.psEquation import EquationCompiler, Evaluation, TermCache, reciprocal_key
+
+EQUATIONS = [
+    ("PD*((1 - exp(-TR/T1))*exp(-TE/T2))", ["TR", "TE"]),
+    ("1-2*exp(-TI/T1)", ["TI"]),
+    ("abs(PD)*exp(-TSAT/T1)*exp(-TE/T2)*(1-2*exp(-TI/T1))", ["TSAT", "TE", "TI"]),
+]
+
+
+def maps_with_zeros():
+    rng = np.random.default_rng(0)
+    maps = {"T1": rng.uniform(200, 4000, (16, 12)), "T2": rng.uniform(10, 300, (16, 12)), "PD": rng.uniform(0, 1, (16, 12))}
+    # failed fit voxels: a single map at 0, and all maps at 0
+    maps["T1"][0, :4] = 0
+    maps["T2"][1, :4] = 0
+    for qmap in maps:
+        maps[qmap][2, :4] = 0
+    return maps
+
+
+def baseline(equation, maps, values):
+    # the equation string evaluated as plain NumPy expressions
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return eval(equation, {"exp": np.exp, "abs": np.abs}, dict(maps, **values))
+
+
+@pytest.mark.parametrize("equation, parameters", EQUATIONS)
+def test_zero_voxels_match_baseline(equation, parameters):
+    maps = maps_with_zeros()
+    values = {p: 10. * (i + 1) for i, p in enumerate(parameters)}
+    compiled = EquationCompiler(["T1", "T2", "PD"]).compile(equation, parameters)
+    expected = baseline(equation, maps, values)
+    params = [values[p] for p in compiled.parameters]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        computed = compiled(maps, params)
+    np.testing.assert_allclose(np.nan_to_num(computed), np.nan_to_num(expected), rtol=1e-12)
+
+    # reciprocal maps precomputed by the qmaps
+    inputs = dict(maps)
+    for qmap in compiled.reciprocal_qmaps:
+        q = Qmap(qmap)
+        q.np_matrix = maps[qmap][:, :, np.newaxis]
+        inputs[reciprocal_key(qmap)] = q.get_reciprocal_matrix(3)[:, :, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        computed = compiled(inputs, params)
+    np.testing.assert_allclose(np.nan_to_num(computed), np.nan_to_num(expected), rtol=1e-12)
+
+
+def test_zero_relaxation_time():
+    maps = maps_with_zeros()
+    compiled = EquationCompiler(["T1", "T2", "PD"]).compile("PD*((1 - exp(-TR/T1))*exp(-TE/T2))", ["TR", "TE"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        img = compiled(maps, [500., 100.])
+    # T2 = 0: exp(-TE/T2) = 0; T1 = 0: 1 - exp(-TR/T1) = 1
+    np.testing.assert_array_equal(img[1, :4], 0)
+    np.testing.assert_allclose(img[0, :4], maps["PD"][0, :4] * np.exp(-100. / maps["T2"][0, :4]))
+
+
+def test_term_cache_reuses_unchanged_terms():
+    equation, parameters = EQUATIONS[2]
+    compiled = EquationCompiler(["T1", "T2", "PD"]).compile(equation, parameters)
+    rng = np.random.default_rng(1)
+    maps = {"T1": rng.uniform(200, 4000, (16, 12)), "T2": rng.uniform(10, 300, (16, 12)),
+            "PD": rng.uniform(0, 1, (16, 12))}
+
+    # count the array terms computed by each evaluation
+    computed = []
+    stack, nodes = [compiled.root], set()
+    while stack:
+        node = stack.pop()
+        if node not in nodes:
+            nodes.add(node)
+            stack.extend(node.children())
+
+    def counted(node, compute):
+        def compute_counted(evaluation):
+            computed.append(node)
+            return compute(evaluation)
+        return compute_counted
+
+    for node in nodes:
+        if node.is_array() and node.children():
+            node.compute = counted(node, node.compute)
+
+    cache = TermCache()
+    values = {"TSAT": 10., "TE": 80., "TI": 2000.}
+    compiled(maps, [values[p] for p in compiled.parameters], cache, slice_key=0)
+    for parameter, value in [("TE", 90.), ("TI", 1800.), ("TE", 70.), ("TSAT", 20.), ("TI", 2200.)]:
+        values[parameter] = value
+        params = [values[p] for p in compiled.parameters]
+        del computed[:]
+        img = compiled(maps, params, cache, slice_key=0)
+        assert computed and all(parameter in node.params for node in computed)
+        np.testing.assert_allclose(img, Evaluation(compiled, maps, values).value(compiled.root), rtol=1e-12)
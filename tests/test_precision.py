@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from src.model.psEquation import EquationCompiler
+from src.model.psSynthEngine import precision_error
+
+EQUATIONS = [
+    ("PD*((1 - exp(-TR/T1))*exp(-TE/T2))", ["TR", "TE"], [500., 100.]),
+    ("abs(PD)*exp(-TSAT/T1)*exp(-TE/T2)*(1-2*exp(-TI/T1))", ["TSAT", "TE", "TI"], [10., 80., 2000.]),
+    ("abs((PD) * ( 1 - 2*exp(-TI_2/T1) + 2*exp(-(TI_1+TI_2)/T1) -  exp(-TR/T1) )) * (exp(-TE/T2))",
+     ["TR", "TE", "TI_1", "TI_2"], [7000., 20., 2800., 500.]),
+]
+
+
+def qmaps():
+    rng = np.random.default_rng(0)
+    shape = (40, 40, 8)
+    return {"T1": rng.uniform(200, 4000, shape), "T2": rng.uniform(10, 300, shape), "PD": rng.uniform(0, 1, shape)}
+
+
+@pytest.mark.parametrize("equation, parameters, values", EQUATIONS)
+@pytest.mark.parametrize("lut_size", [0, 4096])
+def test_float32_close_to_float64(equation, parameters, values, lut_size):
+    compiled = EquationCompiler(["T1", "T2", "PD"]).compile(equation, parameters)
+    maps = {q: m for q, m in qmaps().items() if q in compiled.qmaps}
+    params = [dict(zip(parameters, values))[p] for p in compiled.parameters]
+    assert precision_error(compiled, maps, params, np.float32, lut_size) < 1e-3
+
+
+def test_float64_exact():
+    compiled = EquationCompiler(["T1", "T2", "PD"]).compile(*EQUATIONS[0][:2])
+    assert precision_error(compiled, qmaps(), EQUATIONS[0][2], np.float64) == 0.
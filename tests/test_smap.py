@@ -0,0 +1,110 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+from src.model.MRIImage import Orientation, Qmap, Smap
+from src.model.psEquation import EquationCompiler
+from src.model.psMemory import MemoryManager
+
+CONTRASTS = {
+    "T1W": ("PD*((1 - exp(-TR/T1))*exp(-TE/T2))", {"TR": 500., "TE": 10.}),
+    "T2W": ("PD*((1 - exp(-TR/T1))*exp(-TE/T2))", {"TR": 5000., "TE": 100.}),
+    "PDW": ("PD*((1 - exp(-TR/T1))*exp(-TE/T2))", {"TR": 5000., "TE": 10.}),
+}
+
+
+def make_qmaps(shape=(24, 20, 10)):
+    rng = np.random.default_rng(0)
+    qmaps = dict()
+    for qmap, low, high in [("T1", 200, 4000), ("T2", 10, 300), ("PD", 0, 1)]:
+        q = Qmap(qmap)
+        q.np_matrix = rng.uniform(low, high, shape)
+        q.np_matrix[:4] = 0
+        q.is_loaded = True
+        q.set_init_slices_num()
+        q.set_orientation(Orientation.AXIAL)
+        qmaps[qmap] = q
+    return qmaps
+
+
+def make_smap(qmaps):
+    smap = Smap(qmaps)
+    smap.set_orientation(Orientation.AXIAL)
+    smap.set_init_slices_num(qmaps["T1"])
+    return smap
+
+
+def synthesis_states(smap):
+    compiler = EquationCompiler(["T1", "T2", "PD"])
+    states = []
+    for map_type, (equation, values) in CONTRASTS.items():
+        parameters = {p: {"value": v} for p, v in values.items()}
+        states.append(smap.get_synthesis_state(map_type, compiler.compile(equation, list(values)), parameters))
+    return states
+
+
+def test_synthesize_no_volumes():
+    assert make_smap(make_qmaps()).synthesize_volumes([]) == []
+
+
+def test_prepared_volumes_within_budget():
+    smap = make_smap(make_qmaps())
+    states = synthesis_states(smap)
+    volume_bytes = int(np.prod(states[0][4].shape)) * 4
+    memory = MemoryManager()
+    smap.set_memory_manager(memory)
+    memory.set_budget(memory.nbytes() + 2 * volume_bytes)
+    smap.prepare_volumes(states)
+    assert len(smap._volumes) == 2
+    assert memory.nbytes() <= memory.budget
+
+    smap.release_volumes()
+    assert not smap._volumes
+    assert ("synthetic", "prepared volumes") not in memory._entries
+
+
+def recompute_slice(qmaps, lut_size=0, preview=0):
+    smap = make_smap(qmaps)
+    equation, values = CONTRASTS["T1W"]
+    smap.set_map_type("T1W")
+    smap.set_qmaps_needed(["T1", "T2", "PD"])
+    smap.set_scanner_parameters({p: {"value": v} for p, v in values.items()})
+    smap.set_equation(EquationCompiler(["T1", "T2", "PD"]).compile(equation, list(values)))
+    smap.set_lut_size(lut_size)
+    if preview:
+        return smap.synthesize_preview(preview)
+    smap.recompute_smap()
+    return smap.np_matrix
+
+
+def load_lazy_qmaps(qmaps, tmp_path):
+    lazy_qmaps = dict()
+    for name, qmap in qmaps.items():
+        path = str(tmp_path / (name + ".nii"))
+        nib.save(nib.Nifti1Image(qmap.np_matrix, np.eye(4)), path)
+        lazy_qmaps[name] = Qmap(name, path=path, is_loaded=True)
+        lazy_qmaps[name].load_from_niftii(lazy=True)
+        lazy_qmaps[name].set_orientation(Orientation.AXIAL)
+    return lazy_qmaps
+
+
+@pytest.mark.parametrize("lut_size, preview", [(0, 0), (4096, 0), (0, 2), (4096, 2)])
+def test_lazy_qmaps_stay_lazy(tmp_path, lut_size, preview):
+    qmaps = make_qmaps()
+    lazy_qmaps = load_lazy_qmaps(qmaps, tmp_path)
+    img = recompute_slice(lazy_qmaps, lut_size, preview)
+    assert all(qmap.is_lazy() for qmap in lazy_qmaps.values())
+    np.testing.assert_array_equal(img, recompute_slice(qmaps, lut_size, preview))
+
+
+def test_mask_kept_when_other_qmap_reloaded():
+    qmaps = make_qmaps()
+    smap = make_smap(qmaps)
+    foreground = smap.get_foreground()
+    qmaps["T2"].set_matrix(qmaps["T2"].np_matrix.copy())
+    qmaps["T2"].generation += 1
+    reloaded = smap.get_foreground()
+    assert reloaded is not foreground and reloaded.mask is foreground.mask
+
+    qmaps["T1"].generation += 1
+    assert smap.get_foreground().mask is not foreground.mask
@@ -0,0 +1,11 @@
+from src.model.MRIImage import Smap
+from src.model.psSynthEngine import NumpyBackend, ThreadedBackend
+
+
+def test_replaced_backend_is_shut_down():
+    smap = Smap(dict())
+    backend = ThreadedBackend(threads=2)
+    backend._get_executor()
+    smap.set_backend(backend)
+    smap.set_backend(NumpyBackend())
+    assert backend._executor is None